@@ -2,9 +2,12 @@
 
 __all__ = ["dades_obertes", "estacions", "icgc", "idaea", "idescat"]
 
-import numpy as np
-import pandas as pd
+import importlib
 
+# ---------------------------------------------------------------------------------------------------------------------
+# El paquet es carrega de manera mandrosa: ni numpy/pandas ni els submoduls s'importen fins que no es fan servir.
+# Aixi un proces que nomes necessita get_VUCI o get_scenario no paga el cost d'importar pandas.
+# ---------------------------------------------------------------------------------------------------------------------
 ESTACIONS = {
     "nom_eoi": [
         "Badalona", "Barcelona (Poblenou)", "Barcelona (Sants)", "Barcelona (Eixample)", 
@@ -28,7 +31,7 @@ ESTACIONS = {
                   'SAndreu_Barca', 'SCugat_Valles', 'StaColoma_Gramanet', 'Barbera_Valles', 'SVHorts_Ribot', 'SVHorts', 'Viladecans']
     }
 
-EOI_DF = pd.DataFrame(ESTACIONS)
+# EOI_DF = pd.DataFrame(ESTACIONS) ... es construeix el primer cop que s'hi accedeix (veure __getattr__)
 
 
 # codi_eoi: { "LCZvsNO2_500M": [NO2,LCZ_1,LCZ_2,LCZ_3,LCZ_4,LCZ_5,LCZ_6,LCZ_7,LCZ_8,LCZ_9,LCZ_10,LCZ_A,LCZ_B,LCZ_C,LCZ_D,LCZ_E,LCZ_F,LCZ_G,T_LCZ], 
@@ -100,30 +103,137 @@ EOI_DATA = {
     }
 
 
-from .dades_obertes import HORES, CONTAMINANTS
-from .dades_obertes import get_all_EOI_data, get_contaminant_data, get_data, get_CM
+# submoduls que es carreguen en accedir-hi (AirPollutionData.metrics...); import * nomes porta els de __all__
+_SUBMODULES = {"aggregates", "archive", "batch", "cache", "dades_obertes", "estacions", "fetch", "icgc", "idaea", "idescat",
+               "interpolation", "lcz_raster", "live", "metrics", "risk", "service", "spatial", "sync", "tensor"}
+
+# atribut public -> submodul on esta definit
+_LAZY = {}
+
+def _lazy(module, *names):
+    for name in names:
+        _LAZY[name] = module
+
+
+def __getattr__(name):
+    if name == "EOI_DF":
+        import pandas as pd
+        value = pd.DataFrame(ESTACIONS)
+    elif name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    elif name in _LAZY:
+        value = getattr(importlib.import_module("." + _LAZY[name], __name__), name)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    # el desem al modul perque el proper acces ja no passi per aqui
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY) | _SUBMODULES | {"EOI_DF"})
+
+
+_lazy("dades_obertes", "HORES", "CONTAMINANTS")
+_lazy("dades_obertes", "get_all_EOI_data", "get_contaminant_data", "get_data", "get_CM")
+_lazy("dades_obertes", "invalidate_EOI_data", "warm_EOI_data", "get_risk_query", "get_risk_data", "get_query", "get_range", "get_paged", "read_data_stream")
 # HORES = [f"h0{i}" for i in range(1,10)] + [f"h{i}" for i in range(10,25)]
 # CONTAMINANTS = {"nom":  ['NO2', 'PM2.5', 'SO2', 'PS', 'CO', 'NO', 'PM10', 'PM1', 'NOX', 'O3', 'C6H6', 'HCT', 'HCNM', 'Cl2', 'HCl', 'H2S', 'Hg'], "codi": [ 8, 9, 1, 3, 6, 7, 10, 11, 12, 14, 30, 42, 44, 53, 58, 65, 331]}
-# get_all_EOI_data(ymd) ... obtenim les dades en json de tots els contaminants i de totes les estacions del projecte per una data determinada
-# get_contaminant_data(ymd, contaminante = 'NO2') ... a partir de get_all_EOI_data, filtrem per contaminant
-# get_data(ymd, nom_eoi, contaminante = 'NO2') ... a partir de get_contaminant_data, filtrem per l'estacio
+# get_all_EOI_data(ymd, use_cache = True) ... obtenim les dades en json de tots els contaminants i de totes les estacions del projecte per una data determinada (amb cache local)
+# invalidate_EOI_data(ymd = None, contaminants = None, codis = None) ... esborrem una data (o totes) de la cache local
+# warm_EOI_data(dates, contaminants = ('NO2',), codis = None) ... precarreguem una llista de dates a la cache local (dia sencer i get_risk_data)
+# get_query(where, select, order, limit, offset) ... url SoQL de la consulta ($where, $select, $order, $limit, $offset)
+# get_risk_query(ymd, codis = None, contaminante = 'NO2') ... url (i clau de la cache) de get_risk_data
+# get_risk_data(ymd, codis, contaminante = 'NO2') ... filtre al servidor per data, estacions i contaminant, nomes amb les columnes del risc
+# get_contaminant_data(ymd, contaminante = 'NO2') ... get_risk_data per a totes les estacions del projecte
+# get_data(ymd, nom_eoi, contaminante = 'NO2') ... get_risk_data per a una estacio
+# get_range(start, end, contaminants = None, stations = None, stream = False) ... totes les dades d'un interval de dates (consulta paginada amb DATA_LIMIT)
+# read_data_stream(url, stations = None, contaminants = None) ... lectura en streaming, filtrant i desant a columnes tipades
+# get_paged(where, select = None) ... tots els registres que compleixen els predicats SoQL de where (consulta paginada)
 # get_CM(df)
 
-from .estacions import get_nom_eoi, get_codi_eoi
+_lazy("fetch", "Session", "SESSION", "CircuitOpenError")
+# SESSION ... sessio HTTP compartida (keep-alive, timeouts de connexio/lectura, reintents amb backoff i circuit breaker)
+
+_lazy("estacions", "StationRegistry", "REGISTRY", "LCZ_COLUMNS", "POBLACION_COLUMNS")
+_lazy("estacions", "get_nom_eoi", "get_codi_eoi", "get_etiqueta_codi_eoi")
+# REGISTRY ... StationRegistry amb index per codi, nom i etiqueta, i matrius REGISTRY.lcz (21x19) i REGISTRY.poblacion (21x11)
 # get_nom_eoi(codi)
 # get_codi_eoi(nom)
+# get_etiqueta_codi_eoi(etiqueta)
 
-from .icgc import VUCI, LCZ_NAME, LCZ_DEFINITION
-from .icgc import get_VUCI, get_scenario, get_df_histograma_hores, get_hazard_data, get_LCZ_image, get_LCZ_station_image
+_lazy("icgc", "VUCI", "LCZ_NAME", "LCZ_DEFINITION", "LCZ_KEYS", "SCENARIO_CODES", "SCENARIO_NAMES")
+_lazy("icgc", "get_LCZ_code", "get_VUCI_array", "get_scenario_array")
+_lazy("icgc", "get_VUCI", "get_scenario", "get_df_histograma_hores", "get_hazard_data", "get_hazard_values", "get_LCZ_image", "get_LCZ_station_image")
 # VUCI ... Vulnerability Urban Climate Index (taula Joan Gilabert). Diccionari del tipus lcz:vuci
 # get_VUCI(lcz)
 # get_scenario(vuci, cvp) ... VUCI_CVP scenarios
+# get_LCZ_code(lcz) ... codi enter de la LCZ (posicio a LCZ_KEYS, -1 si es desconeguda)
+# get_VUCI_array(lcz_code) ... VUCI vectoritzat a partir de codis enters de LCZ
+# get_scenario_array(vuci, cvp) ... escenaris VUCI_CVP vectoritzats (index a SCENARIO_CODES / SCENARIO_NAMES)
 # get_df_histograma_hores(contaminante, df)
 # get_hazard_data(contaminante, df) ... mitjana dels valors horaris existents
+# get_hazard_values(df) ... get_hazard_data per a cada fila de df (vectoritzat)
 
-from .idaea import get_NO2_2019, get_LCZmax
+_lazy("idaea", "LCZ_PERCENT")
+_lazy("idaea", "get_NO2_2019", "get_LCZmax", "get_LCZmax_code", "get_LCZ_topk")
 # get_NO2_2019(eoi_code)
 # get_LCZmax(eoi_code) ... retorna el LCZ amb un percentatge d'area mes gran
+# get_LCZmax_code(eoi_codes) ... LCZ dominant (codi enter) de moltes estacions alhora
+# get_LCZ_topk(eoi_codes, k = 3) ... les k LCZ dominants de cada estacio, amb els seus percentatges
+# LCZ_PERCENT ... matriu estacions x LCZ amb els percentatges (precalculada)
 
-from .idescat import get_CVP
+_lazy("idescat", "get_CVP")
 # get_CVP(eoi_code, iP = 1) ... calcul de l'index de envelliment segons diferents formulacions (iP)
+
+_lazy("lcz_raster", "LCZRaster", "LCZ_PALETTE", "classify_rgb", "classify_classes")
+# LCZRaster(classes, transform) ... taules d'arees sumades per LCZ: get_percent / get_LCZmax / get_LCZmax_code / get_VUCI(lon, lat, radi_m)
+# LCZRaster.from_image(path, transform) / LCZRaster.from_geotiff(path) ... raster amb la paleta de les LCZ o de classes de WUDAPT
+# classify_rgb(rgb) ... imatge amb la paleta estandard LCZ_PALETTE -> classes uint8 (255 sense dades)
+# classify_classes(grid) ... graella de classes de WUDAPT (1..17) -> classes uint8
+
+_lazy("tensor", "HourlyStore")
+# HourlyStore(path) ... magatzem float32[estacio, dia, hora] per contaminant, amb memoria mapejada (ingest, get, get_hazard)
+
+_lazy("sync", "StoreSync")
+# StoreSync(store).run(start = None) ... sincronitzacio incremental (marques d'aigua :updated_at / last_date) amb un HourlyStore
+
+_lazy("live", "LiveDay")
+# LiveDay(ymd = None, contaminants = None) ... dia en curs en memoria: poll() demana nomes els registres actualitzats, recalcula les estacions afectades i avisa els subscriptors
+
+_lazy("risk", "COLOR3", "CAPTION3", "RISK_THRESHOLDS", "POLLUTANT_THRESHOLDS")
+_lazy("risk", "get_station_factors", "get_risk_code", "get_risk_batch", "get_risk_table", "get_hazard_grid")
+_lazy("risk", "get_multi_risk")
+# get_station_factors(codis = None) ... vuci, cvpi, escenari i NO2 2019 de cada estacio (calculat una sola vegada)
+# get_risk_code(fhazard) ... semafor de 3 colors (0 sense dades, 1 baix, 2 mitja, 3 alt)
+# get_risk_batch(hazard, codis = None, missing = None, fallback = None) ... hazard, fhazard, risk i escenari per a hazard[estacions, dies]
+# get_risk_table(hazard, dates, codis = None) ... el mateix, com a taula llarga (codi_eoi, data, ...)
+# get_hazard_grid(df, dates, codis = None) ... hazard[estacions, dies] a partir dels registres d'un contaminant
+# get_multi_risk(df, dates = None, codis = None, thresholds = None) ... hazard i risc de tots els contaminants i estacions en una sola passada
+
+_lazy("interpolation", "InterpolationGrid", "get_interpolation_grid", "get_interpolation_image", "haversine")
+# InterpolationGrid(codis = None, size = (120, 100), method = "idw") ... pesos IDW / kriging ordinari precalculats; interpolate(valors) -> graella [ny, nx]
+# get_interpolation_grid(codis = None, size, method = "idw") ... InterpolationGrid en cache (una per combinacio)
+# get_interpolation_image(valors, codis = None, method = "idw") ... (data URI PNG, bounds) per a una BitmapLayer de pydeck
+# haversine(lon1, lat1, lon2, lat2) ... distancia en km (vectoritzada)
+
+_lazy("spatial", "StationIndex", "get_nearest_risk")
+# StationIndex(codis = None) ... estacions mes properes a molts punts: query(lon, lat, k) i query_radius(lon, lat, km)
+# get_nearest_risk(lon, lat, hazard = None, k = 1, radius = None) ... codi_eoi, distancia i risc de l'estacio (o estacions) de cada punt
+
+_lazy("metrics", "span", "timed")
+# span(nom) ... context manager que mesura un bloc i l'afegeix a l'histograma nom (no fa res si AQI_METRICS no esta activat)
+# timed(nom = None) ... decorador equivalent per a funcions
+# metrics.get_prometheus_text() / write_prometheus(path) / serve_prometheus(port, host = "127.0.0.1") ... exportacio en format Prometheus
+
+_lazy("aggregates", "RollingAggregates")
+# RollingAggregates() ... agregats incrementals (dia, 7 i 30 dies, any) per estacio i contaminant: mitjana, mediana, p95, maxim i hores per sobre de llindars
+# RollingAggregates.get_annual_mean(contaminante, any) ... mitjana anual viva (fallback de get_risk_batch en lloc del NO2 2019)
+
+_lazy("archive", "ARCHIVE_DIR", "backfill", "read_archive", "get_annual_means")
+# backfill(start, end, contaminants = None) ... arxiu Parquet local (year/month/contaminant) de l'historic de tasf-thgu; nomes demana els mesos que falten
+# read_archive(start, end, stations = None, contaminants = None) ... lectura amb els filtres aplicats als directoris i row groups (mateix esquema que get_range)
+# get_annual_means(contaminante = 'NO2', start = None, end = None) ... mitjana anual dels valors horaris per estacio (any x codi_eoi)
+
+_lazy("service", "RiskService")
+# RiskService(pollutants = None, archive = None) ... servei HTTP asyncio (python -m AirPollutionData.service): /risk/{data} i /risk/{codi_eoi}/{data} en JSON o Arrow, amb ETag i Cache-Control
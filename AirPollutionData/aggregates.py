@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from . import ESTACIONS
+from .cache import get_ymd
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Agregats incrementals per estacio i contaminant: dia, finestres mobils (7 i 30 dies) i any natural.
+# Per a cada periode: mitjana, mediana, p95, maxim horari i hores per sobre de cada llindar.
+#
+# Cada dia es resumeix en un histograma de valors horaris (bins de BIN_WIDTH). Els histogrames, sumes i
+# comptadors es poden sumar i restar, de manera que afegir un dia es O(1): es suma el dia nou a cada
+# finestra i es resta el que en surt (els darrers dies es guarden en un buffer circular). La mediana i el p95
+# surten de l'histograma acumulat (error maxim BIN_WIDTH / 2); el maxim de les finestres, dels maxims diaris.
+# ---------------------------------------------------------------------------------------------------------------------
+BIN_WIDTH = 1.0
+MAX_VALUE = 1000.0
+WINDOWS = (7, 30)
+THRESHOLDS = (40.0,)
+
+
+class _Period:
+    # acumulador d'un periode: histograma [estacions, bins], suma, nombre d'hores, maxim i hores per sobre dels llindars
+    def __init__(self, nstations, nbins, nthresholds):
+        self.hist = np.zeros((nstations, nbins), dtype=np.int32)
+        self.sum = np.zeros(nstations)
+        self.count = np.zeros(nstations, dtype=np.int64)
+        self.max = np.full(nstations, np.nan)
+        self.above = np.zeros((nstations, nthresholds), dtype=np.int64)
+
+    def add(self, day, sign = 1):
+        self.hist += sign * day.hist
+        self.sum += sign * day.sum
+        self.count += sign * day.count
+        self.above += sign * day.above
+
+
+class RollingAggregates:
+    def __init__(self, stations = None, thresholds = THRESHOLDS, windows = WINDOWS, bin_width = BIN_WIDTH, max_value = MAX_VALUE):
+        self.stations = list(ESTACIONS["codi_eoi"] if stations is None else stations)
+        self.thresholds = np.asarray(thresholds, dtype=float)
+        self.windows = tuple(windows)
+        self.bin_width = bin_width
+        self.nbins = int(np.ceil(max_value / bin_width)) + 1   # l'ultim bin recull els valors >= max_value
+        self.ring = max(self.windows)
+        self.state = {}
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def _new_state(self):
+        shape = (len(self.stations), self.nbins, len(self.thresholds))
+        return {"last_day": None,
+                "days": [None] * self.ring,            # buffer circular amb el resum dels darrers dies
+                "day_index": [None] * self.ring,       # dia (ordinal) que ocupa cada posicio del buffer
+                "windows": {w: _Period(*shape) for w in self.windows},
+                "years": {}}
+
+    def _summarize(self, hours):
+        # hours: [estacions, 24] -> resum del dia (els NaN no compten)
+        hours = np.asarray(hours, dtype=float)
+        valid = ~np.isnan(hours)
+        day = _Period(len(self.stations), self.nbins, len(self.thresholds))
+        ibin = np.clip(np.floor(np.nan_to_num(hours, nan=0.0) / self.bin_width), 0, self.nbins - 1).astype(np.intp)
+        rows = np.broadcast_to(np.arange(len(self.stations))[:, None], hours.shape)
+        np.add.at(day.hist, (rows[valid], ibin[valid]), 1)
+        day.sum = np.where(valid, hours, 0.0).sum(axis=1)
+        day.count = valid.sum(axis=1)
+        day.max = np.where(day.count > 0, np.nanmax(np.where(valid, hours, -np.inf), axis=1), np.nan)
+        day.above = (np.where(valid, hours, -np.inf)[:, :, None] > self.thresholds).sum(axis=1)
+        return day
+
+    def _year(self, state, year):
+        if year not in state["years"]:
+            state["years"][year] = _Period(len(self.stations), self.nbins, len(self.thresholds))
+        return state["years"][year]
+
+    def _remove(self, state, slot):
+        # treu el dia que ocupa la posicio slot del buffer de les finestres on encara compta i del seu any
+        old, oday = state["days"][slot], state["day_index"][slot]
+        if old is None:
+            return
+        for w, period in state["windows"].items():
+            if state["last_day"] - oday < w:
+                period.add(old, -1)
+        self._year(state, pd.Timestamp.fromordinal(oday).year).add(old, -1)
+        state["days"][slot] = state["day_index"][slot] = None
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def add_day(self, contaminant, ymd, hours):
+        # afegeix (o substitueix, si encara es dins del buffer) un dia de valors horaris [estacions, 24]
+        state = self.state.setdefault(contaminant, self._new_state())
+        day_index = pd.Timestamp(get_ymd(ymd)).toordinal()
+        day = self._summarize(hours)
+        last = state["last_day"]
+
+        if last is not None and day_index <= last:
+            # revisio d'un dia ja ingerit (el maxim anual no es pot restar: queda com a cota superior)
+            if last - day_index >= self.ring:
+                raise ValueError(f"{get_ymd(ymd)} is older than the {self.ring}-day window buffer")
+            slot = day_index % self.ring
+            if state["day_index"][slot] == day_index:
+                self._remove(state, slot)
+        else:
+            # avancem fins al dia nou: els dies que surten de cada finestra es resten i els que surten del buffer s'esborren
+            for slot, d in enumerate(state["day_index"]):
+                if d is None:
+                    continue
+                for w, period in state["windows"].items():
+                    if last - d < w <= day_index - d:
+                        period.add(state["days"][slot], -1)
+                if d <= day_index - self.ring:
+                    state["days"][slot] = state["day_index"][slot] = None
+            state["last_day"] = day_index
+
+        slot = day_index % self.ring
+        state["days"][slot], state["day_index"][slot] = day, day_index
+        for w, period in state["windows"].items():
+            if state["last_day"] - day_index < w:
+                period.add(day)
+        year = self._year(state, pd.Timestamp.fromordinal(day_index).year)
+        year.add(day)
+        year.max = np.fmax(year.max, day.max)
+
+    def add_days(self, contaminant, start, hours):
+        # hours: [estacions, dies, 24] (p.ex. HourlyStore.get) a partir del dia start
+        for i, ymd in enumerate(pd.date_range(get_ymd(start), periods=hours.shape[1], freq="D")):
+            self.add_day(contaminant, ymd, hours[:, i, :])
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def _quantile(self, hist, q):
+        total = hist.sum(axis=1)
+        ibin = (hist.cumsum(axis=1) < (q * total)[:, None]).sum(axis=1)
+        value = (np.minimum(ibin, self.nbins - 1) + 0.5) * self.bin_width
+        return np.where(total > 0, value, np.nan)
+
+    def _frame(self, period, maxim):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(period.count > 0, period.sum / period.count, np.nan)
+        df = pd.DataFrame({"codi_eoi": self.stations, "hours": period.count, "mean": np.round(mean, 2),
+                           "median": self._quantile(period.hist, 0.5), "p95": self._quantile(period.hist, 0.95),
+                           "max": maxim})
+        for t, threshold in enumerate(self.thresholds):
+            df[f"hours_above_{threshold:g}"] = period.above[:, t]
+        return df
+
+    def get(self, contaminant, window = 1):
+        # agregats de la finestra de window dies que acaba el darrer dia ingerit (window = 1: nomes aquest dia)
+        state = self.state[contaminant]
+        last = state["last_day"]
+        if window == 1:
+            period = state["days"][last % self.ring]
+            return self._frame(period, period.max)
+        if window not in state["windows"]:
+            raise ValueError(f"window must be 1 or one of {self.windows}")
+        maxs = [state["days"][(last - d) % self.ring].max for d in range(window)
+                if state["day_index"][(last - d) % self.ring] == last - d]
+        maxim = np.fmax.reduce(maxs) if maxs else np.full(len(self.stations), np.nan)
+        return self._frame(state["windows"][window], maxim)
+
+    def get_annual(self, contaminant, year):
+        # agregats de l'any natural (fins al darrer dia ingerit)
+        year = self.state[contaminant]["years"].get(int(year))
+        if year is None:
+            return self._frame(_Period(len(self.stations), self.nbins, len(self.thresholds)), np.full(len(self.stations), np.nan))
+        return self._frame(year, year.max)
+
+    def get_annual_mean(self, contaminant, year):
+        # mitjana anual per estacio (alineada amb self.stations): substitut "viu" de get_NO2_2019
+        return self.get_annual(contaminant, year)["mean"].to_numpy()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari: comparem amb el calcul directe sobre tot l'historic
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    days = 60
+    hours = rng.gamma(4.0, 8.0, size=(len(ESTACIONS["codi_eoi"]), days, 24))
+    hours[rng.random(hours.shape) < 0.05] = np.nan
+
+    agg = RollingAggregates()
+    agg.add_days('NO2', '2022-01-01', hours)
+    last7 = hours[:, -7:, :].reshape(len(ESTACIONS["codi_eoi"]), -1)
+    df = agg.get('NO2', 7)
+    print(f"7d mean error: {np.nanmax(np.abs(df['mean'] - np.round(np.nanmean(last7, axis=1), 2))):.4f} | 0.0000")
+    print(f"7d median error: {np.nanmax(np.abs(df['median'] - np.nanmedian(last7, axis=1))):.2f} | <= {BIN_WIDTH / 2 + 0.5}")
+    print(f"7d max error: {np.nanmax(np.abs(df['max'] - np.nanmax(last7, axis=1))):.4f} | 0.0000")
+    print(f"7d hours above 40: {(df['hours_above_40'] == (last7 > 40).sum(axis=1)).all()} | True")
+    annual = agg.get_annual_mean('NO2', 2022)
+    flat = hours.reshape(len(ESTACIONS["codi_eoi"]), -1)
+    print(f"annual mean error: {np.nanmax(np.abs(annual - np.round(np.nanmean(flat, axis=1), 2))):.4f} | 0.0000")
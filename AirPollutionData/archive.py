@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from . import ESTACIONS
+from .cache import CACHE_DIR, get_ymd, is_closed_day
+from .dades_obertes import HORES, get_range, normalize_data
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Arxiu historic local del dataset tasf-thgu (estacions del projecte) en Parquet, particionat a la manera de Hive:
+#
+#   <arxiu>/year=2019/month=3/contaminant=NO2/part-0.parquet
+#
+#   python -m AirPollutionData.archive --start 1991-01-01 --end 2024-12-31     # backfill (es pot reprendre)
+#   read_archive("2019-01-01", "2019-12-31", stations=[...], contaminants=['NO2'])
+#
+# El backfill demana trams de fins a CHUNK_MONTHS mesos seguits (una consulta paginada per tram, uns quants trams
+# en paral.lel) i escriu un fitxer per mes i contaminant; les files d'estacions que no s'han demanat es conserven,
+# de manera que backfills amb subconjunts d'estacions es van sumant. Per a cada mes tancat, _archive.json anota
+# quines estacions hi ha de cada contaminant i nomes es torna a demanar si en falta alguna; el mes en curs es torna
+# a descarregar a cada execucio.
+# Dins de cada fitxer les files van ordenades per codi_eoi i data en row groups de ROW_GROUP_SIZE files: les
+# estadistiques (min/max) de cada row group permeten saltar-se els que no tenen les estacions demanades.
+# read_archive tradueix dates, estacions i contaminants a un filtre de pyarrow.dataset: els directoris que queden
+# fora de l'interval o dels contaminants no s'obren, i dels fitxers nomes es llegeixen els row groups necessaris.
+# Necessita pyarrow.
+# ---------------------------------------------------------------------------------------------------------------------
+ARCHIVE_DIR = os.environ.get("AQI_ARCHIVE_DIR", os.path.join(CACHE_DIR, "archive"))
+# els fitxers que comencen per "_" o "." no formen part del dataset per a pyarrow
+ARCHIVE_FILE = "_archive.json"
+SELECT_ARCHIVE = ["codi_eoi", "data", "contaminant"] + HORES
+COLUMNS = ["codi_eoi", "data", "contaminant"] + HORES
+CHUNK_MONTHS = 12
+ROW_GROUP_SIZE = 256
+WORKERS = 2
+
+
+def get_partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([("year", pa.int16()), ("month", pa.int8()), ("contaminant", pa.string())]),
+                           flavor="hive")
+
+
+def get_month_path(path, year, month, contaminant):
+    return os.path.join(path, f"year={year}", f"month={month}", f"contaminant={contaminant}")
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def write_month(df, year, month, path = None, stations = None):
+    # escriu les files d'un mes (totes les de df han de ser d'aquell mes), un fitxer per contaminant
+    # stations ... estacions que df substitueix (per defecte, les de df); les altres files del fitxer es conserven
+    # l'escriptura es atomica: tornar a escriure un mes revisat es idempotent
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    path = path or ARCHIVE_DIR
+    for contaminant, part in df.groupby("contaminant", observed=True, sort=False):
+        part = part.sort_values(["codi_eoi", "data"])
+        hores = part.reindex(columns=HORES).to_numpy(dtype=np.float32, na_value=np.nan)
+        table = pa.table({"codi_eoi": pa.array(part["codi_eoi"].astype(str).to_numpy(), pa.string()),
+                          "data": pa.array(part["data"].to_numpy().astype("datetime64[s]")),
+                          **{h: pa.array(hores[:, i]) for i, h in enumerate(HORES)}})
+        directory = get_month_path(path, year, month, contaminant)
+        file = os.path.join(directory, "part-0.parquet")
+        if os.path.exists(file):
+            replaced = pa.array(sorted(set(part["codi_eoi"].astype(str)) | set(stations or [])), pa.string())
+            # parquet guarda els timestamp[s] com a ms: es torna a l'esquema de table
+            old = pq.read_table(file).cast(table.schema)
+            old = old.filter(pc.invert(pc.is_in(old["codi_eoi"], value_set=replaced)))
+            if old.num_rows:
+                table = pa.concat_tables([old, table]).sort_by([("codi_eoi", "ascending"), ("data", "ascending")])
+        os.makedirs(directory, exist_ok=True)
+        tmp = os.path.join(directory, f".part-0.{os.getpid()}.tmp")
+        pq.write_table(table, tmp, row_group_size=ROW_GROUP_SIZE, compression="zstd")
+        os.replace(tmp, file)
+
+
+def load_state(path = None):
+    # mes ('YYYY-MM') -> {contaminant ("*" si son tots): [estacions arxivades]}
+    file = os.path.join(path or ARCHIVE_DIR, ARCHIVE_FILE)
+    if not os.path.exists(file):
+        return {}
+    with open(file) as f:
+        state = json.load(f)
+    # format antic (nomes contaminants, "*" o llista): eren backfills de totes les estacions del projecte
+    for month, done in state.items():
+        if not isinstance(done, dict):
+            state[month] = {c: list(ESTACIONS["codi_eoi"]) for c in (["*"] if done == "*" else done)}
+    return state
+
+
+def save_state(state, path = None):
+    file = os.path.join(path or ARCHIVE_DIR, ARCHIVE_FILE)
+    tmp = f"{file}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=0, sort_keys=True)
+    os.replace(tmp, file)
+
+
+def get_covered(done, contaminant):
+    # estacions arxivades d'un mes per a un contaminant (les anotades amb "*" valen per a tots)
+    return set(done.get("*", [])) | set(done.get(contaminant, []))
+
+
+def get_pending(start, end, contaminants, state, stations = None):
+    # mesos de [start, end] que falten: no anotats, encara oberts o sense alguna de les parelles
+    # (contaminant, estacio) demanades
+    stations = set(ESTACIONS["codi_eoi"] if stations is None else stations)
+    pending = []
+    for month in pd.period_range(get_ymd(start), get_ymd(end), freq="M"):
+        done = state.get(str(month))
+        if done is None or not is_closed_day(month.end_time):
+            pending.append(month)
+        elif not all(stations <= get_covered(done, c) for c in (contaminants or ["*"])):
+            pending.append(month)
+    return pending
+
+
+def set_done(state, month, contaminants, stations):
+    done = state.setdefault(str(month), {})
+    for c in (contaminants or ["*"]):
+        done[c] = sorted(set(done.get(c, [])) | set(stations))
+
+
+def get_chunks(months, size = CHUNK_MONTHS):
+    # trams de mesos consecutius, de size mesos com a molt
+    chunks = []
+    for month in months:
+        if chunks and len(chunks[-1]) < size and chunks[-1][-1] + 1 == month:
+            chunks[-1].append(month)
+        else:
+            chunks.append([month])
+    return chunks
+
+
+def fetch_chunk(months, contaminants = None, stations = None, path = None):
+    # descarrega un tram de mesos i l'escriu a l'arxiu; retorna (mesos, files)
+    stations = list(ESTACIONS["codi_eoi"] if stations is None else stations)
+    df = get_range(months[0].start_time, months[-1].end_time, contaminants, stations, select=SELECT_ARCHIVE)
+    if not df.empty:
+        for month, part in df.groupby(df["data"].dt.to_period("M"), sort=False):
+            write_month(part, month.year, month.month, path, stations)
+    return months, len(df)
+
+
+def backfill(start, end, contaminants = None, stations = None, path = None, workers = WORKERS, progress = sys.stderr):
+    # omple l'arxiu amb tots els mesos de [start, end] que falten; retorna el nombre de files descarregades
+    path = path or ARCHIVE_DIR
+    os.makedirs(path, exist_ok=True)
+    state = load_state(path)
+    stations = list(ESTACIONS["codi_eoi"] if stations is None else stations)
+    chunks = get_chunks(get_pending(start, end, contaminants, state, stations))
+    rows = 0
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(fetch_chunk, chunk, contaminants, stations, path) for chunk in chunks]
+        for done, future in enumerate(as_completed(futures), 1):
+            months, n = future.result()
+            rows += n
+            # nomes s'anoten els mesos tancats, i despres d'haver escrit els fitxers (un tall no deixa forats)
+            for month in months:
+                if is_closed_day(month.end_time):
+                    set_done(state, month, contaminants, stations)
+            save_state(state, path)
+            if progress is not None:
+                elapsed = time.perf_counter() - t0
+                progress.write(f"\r{done}/{len(chunks)} chunks | {rows} rows | {rows / elapsed:,.0f} rows/s | {elapsed:.1f}s")
+                progress.flush()
+    if progress is not None and chunks:
+        progress.write("\n")
+    return rows
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def get_filter(start = None, end = None, stations = None, contaminants = None):
+    # filtre de pyarrow.dataset; les condicions sobre year/month/contaminant poden les particions (directoris)
+    # i les de data/codi_eoi, els row groups (estadistiques min/max)
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    year, month, data = ds.field("year"), ds.field("month"), ds.field("data")
+    conditions = []
+    if start is not None:
+        start = pd.Timestamp(get_ymd(start))
+        conditions += [(year > start.year) | ((year == start.year) & (month >= start.month)),
+                       data >= pa.scalar(start.to_pydatetime(), pa.timestamp("s"))]
+    if end is not None:
+        end = pd.Timestamp(get_ymd(end))
+        conditions += [(year < end.year) | ((year == end.year) & (month <= end.month)),
+                       data <= pa.scalar(end.to_pydatetime(), pa.timestamp("s"))]
+    if stations is not None:
+        conditions.append(ds.field("codi_eoi").isin([str(s) for s in stations]))
+    if contaminants is not None:
+        conditions.append(ds.field("contaminant").isin(list(contaminants)))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def get_dataset(path = None):
+    import pyarrow.dataset as ds
+    return ds.dataset(path or ARCHIVE_DIR, format="parquet", partitioning=get_partitioning())
+
+
+def read_archive(start = None, end = None, stations = None, contaminants = None, columns = None, path = None):
+    # registres arxivats de [start, end] (dates incloses), amb el mateix esquema que get_range
+    # (codi_eoi, data, contaminant, h01..h24, eoi_id, contaminant_id), ordenats per data, codi_eoi i contaminant
+    path = path or ARCHIVE_DIR
+    if not os.path.isdir(path):
+        return pd.DataFrame()
+    dataset = get_dataset(path)
+    table = dataset.to_table(columns=columns or COLUMNS, filter=get_filter(start, end, stations, contaminants))
+    if not table.num_rows:
+        return pd.DataFrame()
+    df = table.to_pandas()
+    df = df.sort_values([c for c in ("data", "codi_eoi", "contaminant") if c in df.columns], ignore_index=True)
+    return normalize_data(df)
+
+
+def get_annual_means(contaminant = 'NO2', start = None, end = None, stations = None, path = None):
+    # mitjana anual dels valors horaris de cada estacio (com el NO2 2019 de l'IDAEA, per a tots els anys arxivats)
+    # -> DataFrame any x codi_eoi
+    df = read_archive(start, end, stations, [contaminant], columns=["codi_eoi", "data"] + HORES, path=path)
+    if df.empty:
+        return pd.DataFrame()
+    values = df[HORES].to_numpy(dtype=float)
+    totals = pd.DataFrame({"year": df["data"].dt.year, "codi_eoi": df["codi_eoi"],
+                           "sum": np.nansum(values, axis=1), "hours": (~np.isnan(values)).sum(axis=1)})
+    totals = totals.groupby(["year", "codi_eoi"], observed=True)[["sum", "hours"]].sum()
+    means = (totals["sum"] / totals["hours"].where(totals["hours"] > 0)).round(2).unstack("codi_eoi")
+    codis = [c for c in (ESTACIONS["codi_eoi"] if stations is None else stations) if c in means.columns]
+    return means.reindex(columns=codis)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog="python -m AirPollutionData.archive",
+                                     description="Backfill a local Parquet archive (year/month/pollutant) of the tasf-thgu dataset")
+    parser.add_argument("--start", required=True, help="first day (YYYY-MM-DD)")
+    parser.add_argument("--end", default=None, help="last day (YYYY-MM-DD, default: today)")
+    parser.add_argument("--pollutants", nargs="+", default=None, help="pollutants (default: all)")
+    parser.add_argument("--stations", nargs="+", default=None, help="codi_eoi list (default: all project stations)")
+    parser.add_argument("--archive", default=ARCHIVE_DIR, help=f"archive directory (default: {ARCHIVE_DIR})")
+    parser.add_argument("--workers", type=int, default=WORKERS, help=f"chunks fetched in parallel (default: {WORKERS})")
+    args = parser.parse_args(argv)
+
+    end = args.end or pd.Timestamp.today()
+    rows = backfill(args.start, end, args.pollutants, args.stations, args.archive, args.workers)
+    print(f"{rows} rows archived to {args.archive}")
+
+
+if __name__ == '__main__':
+    main()
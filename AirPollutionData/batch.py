@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from . import ESTACIONS
+from .dades_obertes import HORES, get_range
+from .risk import get_multi_risk
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Informe diari de risc (hazard, escenari i semafor) per a totes les estacions del projecte en un interval de dates.
+#
+#   python -m AirPollutionData.batch --start 2022-01-01 --end 2022-12-31 --pollutants NO2 PM10 --output risk.parquet
+#
+# L'interval es parteix en trams de --chunk-days dies, que es calculen en paral.lel en un pool de processos.
+# ---------------------------------------------------------------------------------------------------------------------
+SELECT_BATCH = ["codi_eoi", "data", "contaminant"] + HORES
+
+
+def get_chunks(start, end, chunk_days):
+    # trams [inici, final] consecutius que cobreixen [start, end]
+    starts = pd.date_range(start, end, freq=f"{chunk_days}D")
+    return [(s, min(s + pd.Timedelta(days=chunk_days - 1), pd.Timestamp(end))) for s in starts]
+
+
+def compute_chunk(start, end, pollutants, stations = None):
+    # descarrega un tram i en calcula el risc; retorna la taula llarga (codi_eoi, data, contaminant, ...)
+    codis = list(ESTACIONS["codi_eoi"] if stations is None else stations)
+    dates = pd.date_range(start, end, freq="D")
+    df = get_range(start, end, contaminants=pollutants, stations=codis, select=SELECT_BATCH)
+    # tots els contaminants en una sola passada (llindars de POLLUTANT_THRESHOLDS)
+    return get_multi_risk(df, dates, codis, pollutants)
+
+
+def run(start, end, pollutants, stations = None, chunk_days = 31, workers = None, progress = sys.stderr):
+    chunks = get_chunks(start, end, chunk_days)
+    if not chunks:
+        # interval buit (start > end): informe sense files, amb les mateixes columnes
+        codis = list(ESTACIONS["codi_eoi"] if stations is None else stations)
+        return get_multi_risk(pd.DataFrame(columns=SELECT_BATCH), pd.DatetimeIndex([]), codis, pollutants)
+    tables = []
+    rows = 0
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(compute_chunk, s, e, pollutants, stations) for s, e in chunks]
+        for done, future in enumerate(as_completed(futures), 1):
+            tables.append(future.result())
+            rows += len(tables[-1])
+            if progress is not None:
+                elapsed = time.perf_counter() - t0
+                progress.write(f"\r{done}/{len(chunks)} chunks | {rows} rows | {rows / elapsed:,.0f} rows/s | {elapsed:.1f}s")
+                progress.flush()
+    if progress is not None:
+        progress.write("\n")
+    df = pd.concat(tables, ignore_index=True)
+    return df.sort_values(["data", "contaminant", "codi_eoi"], ignore_index=True)
+
+
+def save(df, output):
+    # .parquet (necessita pyarrow o fastparquet) o, per defecte, CSV
+    if output.endswith(".parquet"):
+        df.to_parquet(output, index=False)
+    else:
+        df.to_csv(output, index=False)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog="python -m AirPollutionData.batch",
+                                     description="Daily AQI risk for all project stations over a date range")
+    parser.add_argument("--start", required=True, help="first day (YYYY-MM-DD)")
+    parser.add_argument("--end", required=True, help="last day (YYYY-MM-DD)")
+    parser.add_argument("--pollutants", nargs="+", default=['NO2'], help="pollutants (default: NO2)")
+    parser.add_argument("--stations", nargs="+", default=None, help="codi_eoi list (default: all project stations)")
+    parser.add_argument("--output", default="risk.csv", help="report file, .csv or .parquet (default: risk.csv)")
+    parser.add_argument("--chunk-days", type=int, default=31, help="days per worker task (default: 31)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+    if pd.Timestamp(args.start) > pd.Timestamp(args.end):
+        parser.error(f"--start {args.start} is after --end {args.end}")
+
+    df = run(args.start, args.end, args.pollutants, args.stations, args.chunk_days, args.workers)
+    save(df, args.output)
+    print(f"{len(df)} rows written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
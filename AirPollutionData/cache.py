@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import pickle
+import sqlite3
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Cache local (SQLite) de les respostes del dataset de dades obertes.
+# Cada entrada es guarda amb una clau (normalment la data 'YYYY-MM-DD') i el moment en que s'ha descarregat.
+#  - dies tancats (anteriors a avui) ... no caduquen mai
+#  - dia d'avui (dades parcials)     ... caduquen passats TODAY_TTL segons
+# Una entrada caducada es continua servint de seguida (stale-while-revalidate) mentre un fil de fons
+# la torna a descarregar; si la descarrega falla, es mante l'ultima resposta bona.
+CACHE_DIR = os.environ.get("AQI_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "AirPollutionData"))
+CACHE_FILE = "tasf-thgu.sqlite"
+TODAY_TTL = 300
+REFRESH_WORKERS = 2
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def get_ymd(ymd):
+    # normalitzem la data (str, date, datetime, Timestamp) al format 'YYYY-MM-DD'
+    return pd.Timestamp(ymd).strftime("%Y-%m-%d")
+
+
+def is_closed_day(ymd):
+    # un dia esta tancat quan ja no pot rebre mes valors horaris
+    return get_ymd(ymd) < datetime.date.today().isoformat()
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+class DataCache:
+    def __init__(self, path=None, ttl=TODAY_TTL):
+        self.path = path or os.path.join(CACHE_DIR, CACHE_FILE)
+        self.ttl = ttl
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.executor = None
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._connect() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS dades (clau TEXT PRIMARY KEY, ymd TEXT, fetched REAL, data BLOB)")
+            con.execute("CREATE INDEX IF NOT EXISTS dades_ymd ON dades (ymd)")
+
+    def _connect(self):
+        # una connexio per crida: streamlit executa cada sessio en un fil diferent
+        return sqlite3.connect(self.path, timeout=30)
+
+    def is_fresh(self, ymd, fetched, empty=False):
+        # els dies tancats no caduquen, excepte si la resposta era buida (dades encara no publicades)
+        if is_closed_day(ymd) and not empty:
+            return True
+        return (time.time() - fetched) < self.ttl
+
+    def get_entry(self, ymd, clau=None):
+        # retorna (df, fresc) o None si no hi ha res desat
+        clau = clau or get_ymd(ymd)
+        with self._connect() as con:
+            row = con.execute("SELECT fetched, data FROM dades WHERE clau = ?", (clau,)).fetchone()
+        if row is None:
+            return None
+        df = pickle.loads(row[1])
+        return df, self.is_fresh(ymd, row[0], df.empty)
+
+    def get(self, ymd, clau=None):
+        # nomes les entrades fresques
+        entry = self.get_entry(ymd, clau)
+        if entry is None or not entry[1]:
+            return None
+        return entry[0]
+
+    def put(self, ymd, df, clau=None):
+        clau = clau or get_ymd(ymd)
+        blob = sqlite3.Binary(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+        with self._connect() as con:
+            con.execute("INSERT OR REPLACE INTO dades (clau, ymd, fetched, data) VALUES (?, ?, ?, ?)",
+                        (clau, get_ymd(ymd), time.time(), blob))
+
+    def get_or_fetch(self, ymd, fetch, clau=None, stale_while_revalidate=True):
+        # fetch(ymd) nomes es crida si no hi ha cap entrada valida a la cache
+        entry = self.get_entry(ymd, clau)
+        if entry is not None and entry[1]:
+            return entry[0]
+        if entry is not None and stale_while_revalidate:
+            self.refresh(ymd, fetch, clau)
+            return entry[0]
+        try:
+            df = fetch(ymd)
+        except Exception:
+            # sense resposta del servidor, millor l'ultima dada bona que res
+            if entry is not None:
+                return entry[0]
+            raise
+        self.put(ymd, df, clau)
+        return df
+
+    def refresh(self, ymd, fetch, clau=None):
+        # torna a descarregar una entrada en un fil de fons (com a molt una descarrega per clau alhora)
+        clau = clau or get_ymd(ymd)
+        with self.lock:
+            if clau in self.refreshing:
+                return None
+            self.refreshing.add(clau)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="cache-refresh")
+
+        def task():
+            try:
+                self.put(ymd, fetch(ymd), clau)
+            except Exception:
+                # es mante l'entrada antiga; ja es tornara a provar a la propera consulta
+                pass
+            finally:
+                with self.lock:
+                    self.refreshing.discard(clau)
+
+        return self.executor.submit(task)
+
+    def invalidate(self, ymd=None, clau=None):
+        # sense data, buidem tota la cache; amb clau, nomes aquesta entrada (si no, totes les claus de la data)
+        with self._connect() as con:
+            if clau is not None:
+                con.execute("DELETE FROM dades WHERE clau = ?", (clau,))
+            elif ymd is None:
+                con.execute("DELETE FROM dades")
+            else:
+                con.execute("DELETE FROM dades WHERE ymd = ?", (get_ymd(ymd),))
+
+    def warm(self, dates, fetch, clau=None):
+        # precarreguem una llista de dates; retorna les dates que s'han hagut de descarregar
+        fetched = []
+        for ymd in dates:
+            if self.get(ymd, clau) is None:
+                self.put(ymd, fetch(ymd), clau)
+                fetched.append(get_ymd(ymd))
+        return fetched
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import tempfile
+
+    cache = DataCache(os.path.join(tempfile.mkdtemp(), CACHE_FILE), ttl=0)
+    calls = []
+    def fetch(ymd):
+        calls.append(ymd)
+        return pd.DataFrame({"h01": [1.0]})
+
+    cache.get_or_fetch("2022-01-01", fetch)
+    cache.get_or_fetch("2022-01-01", fetch)
+    print(f"past day fetched {len(calls)} time(s) | 1")
+    today = datetime.date.today()
+    cache.get_or_fetch(today, fetch)
+    cache.get_or_fetch(today, fetch, stale_while_revalidate=False)
+    print(f"today with ttl=0 fetched {len(calls) - 1} time(s) | 2")
+    cache.invalidate("2022-01-01")
+    print(f"after invalidate: {cache.get('2022-01-01')} | None")
+
+    # stale-while-revalidate: l'entrada caducada es serveix de seguida i es refresca de fons
+    def slow_fetch(ymd):
+        time.sleep(0.5)
+        return pd.DataFrame({"h01": [2.0]})
+    t0 = time.perf_counter()
+    df = cache.get_or_fetch(today, slow_fetch)
+    print(f"stale value {df.h01.iloc[0]} in {time.perf_counter() - t0:.3f}s | 1.0 in ~0s")
+    time.sleep(1.0)
+    print(f"refreshed value {cache.get_entry(today)[0].h01.iloc[0]} | 2.0")
@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import os
+import io
+import json
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, quote
+
 import pandas as pd
 import numpy as np
 
 from . import ESTACIONS
+from .cache import DataCache, get_ymd
+from .fetch import SESSION
+from .metrics import span
 
 DATA_ID = "tasf-thgu"
 DATA_DOMAIN = "analisi.transparenciacatalunya.cat"
@@ -11,6 +21,8 @@ DATA_LIMIT = 50000
 
 URL_DATA = "https://" + DATA_DOMAIN + "/resource/" + DATA_ID + ".json?"
 #"https://analisi.transparenciacatalunya.cat/resource/tasf-thgu.json?"
+# permet apuntar a un servidor local (proves, replay de respostes enregistrades...)
+URL_DATA = os.environ.get("AQI_DATA_URL", URL_DATA)
 
 
 HORES = [f"h0{i}" for i in range(1,10)] + [f"h{i}" for i in range(10,25)]
@@ -21,10 +33,261 @@ CONTAMINANTS = {
     "codi": [ 8, 9, 1, 3, 6, 7, 10, 11, 12, 14, 30, 42, 44, 53, 58, 65, 331]
     }
 
+
+# columnes que necessita el calcul del risc (les de coordenades ja les reanomenem a lon, lat)
+SELECT_RISK = ["codi_eoi", "longitud AS lon", "latitud AS lat"] + HORES
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Constructor de consultes SoQL
+# ---------------------------------------------------------------------------------------------------------------------
+def where_date(ymd):
+    return f"data='{get_ymd(ymd)}T00:00:00.000'"
+
+
+def where_between(start, end):
+    return f"data between '{get_ymd(start)}T00:00:00.000' and '{get_ymd(end)}T00:00:00.000'"
+
+
+def where_in(column, values):
+    llista = ",".join("'" + str(v).replace("'", "''") + "'" for v in values)
+    return f"{column} in({llista})"
+
+
+def get_query(where = None, select = None, order = None, limit = None, offset = None):
+    # construim la url de la consulta; where es una llista de predicats que s'uneixen amb AND
+    params = {}
+    if select:
+        params["$select"] = ",".join(select)
+    if where:
+        params["$where"] = " AND ".join(where)
+    if order:
+        params["$order"] = order
+    if limit is not None:
+        params["$limit"] = limit
+    if offset is not None:
+        params["$offset"] = offset
+    return URL_DATA + urlencode(params, quote_via=quote, safe="$,'()=:")
+
+
+def read_data(url, session = SESSION):
+    # la descarrega passa per la sessio (keep-alive, timeouts, reintents i circuit breaker)
+    # codi_eoi es text ('08019043'); si deixem que pandas l'infereixi perdem el zero inicial
+    with span("socrata.fetch"):
+        body = session.get(url)
+    with span("socrata.parse"):
+        return normalize_data(pd.read_json(io.BytesIO(body), orient='records', dtype={"codi_eoi": str}))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Esquema compacte dels registres descarregats: normalize_data s'aplica just despres del parse.
+#   - textos que es repeteixen a cada registre (nom_estacio, municipi, contaminant...) -> category
+#   - h01..h24 -> float32 (NaN a les hores que falten)
+#   - data -> datetime64[s] (Socrata la retorna com a text)
+#   - lon/lat -> float32, magnitud -> enter petit
+#   - eoi_id / contaminant_id -> int8: posicio a ESTACIONS["codi_eoi"] / CONTAMINANTS["nom"] (-1 si no hi es)
+#   - geocoded_column (diccionaris amb les mateixes coordenades que lon/lat) es descarta
+# Un any de registres ocupa unes 3 vegades menys (python benchmarks/memory.py).
+# ---------------------------------------------------------------------------------------------------------------------
+CATEGORY_COLUMNS = ["codi_eoi", "nom_estacio", "tipus_estacio", "area_urbana", "codi_ine", "municipi",
+                    "codi_comarca", "nom_comarca", "contaminant", "unitats"]
+FLOAT32_COLUMNS = ["lon", "lat", "longitud", "latitud"] + HORES
+DROP_COLUMNS = ["geocoded_column"]
+
+
+def normalize_data(df):
+    # retorna una copia de df amb l'esquema compacte (les columnes que no hi son s'ignoren)
+    if df.empty:
+        return df
+    df = df.drop(columns=[c for c in DROP_COLUMNS if c in df.columns])
+    columns = {}
+    for c in CATEGORY_COLUMNS:
+        if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype):
+            columns[c] = df[c].astype("category")
+    for c in FLOAT32_COLUMNS:
+        if c in df.columns and df[c].dtype != np.float32:
+            columns[c] = pd.to_numeric(df[c], errors="coerce").astype(np.float32)
+    if "magnitud" in df.columns:
+        columns["magnitud"] = pd.to_numeric(df["magnitud"], errors="coerce", downcast="integer")
+    if "data" in df.columns and df["data"].dtype != "datetime64[s]":
+        columns["data"] = pd.to_datetime(df["data"]).astype("datetime64[s]")
+    if "codi_eoi" in df.columns:
+        columns["eoi_id"] = get_positions(ESTACIONS["codi_eoi"], df["codi_eoi"]).astype(np.int8)
+    if "contaminant" in df.columns:
+        columns["contaminant_id"] = get_positions(CONTAMINANTS["nom"], df["contaminant"]).astype(np.int8)
+    return df.assign(**columns)
+
+
+def get_positions(values, column):
+    # posicio de cada element de column a values (-1 si no hi es), com pd.Index(values).get_indexer(column)
+    # amb una columna category nomes es busquen les categories
+    index = pd.Index(values)
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        return index.get_indexer(column.astype(str))
+    lookup = np.append(index.get_indexer(column.cat.categories.astype(str)), -1)
+    return lookup[column.cat.codes.to_numpy()]
+
+
+def get_days(column):
+    # dia (datetime64, a les 00:00) de cada registre; amb l'esquema compacte ja es una data i no cal tornar-la a parsejar
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column.dt.normalize()
+    return pd.to_datetime(column).dt.normalize()
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Lectura en streaming: els registres es llegeixen a mesura que arriben, es filtren per estacio i contaminant
+# i es copien directament a columnes tipades preassignades. La memoria maxima depen dels registres que ens
+# quedem, no de la mida de la resposta (no hi ha mai el cos sencer, ni l'arbre d'objectes, ni el DataFrame complet).
+# ---------------------------------------------------------------------------------------------------------------------
+def iter_records(chunks):
+    # chunks: iterable de bytes amb un array JSON d'objectes ([{...}, {...}, ...]) -> genera els objectes un a un
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buf, pos, closed = "", 0, False
+    for chunk in chunks:
+        buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+        while not closed:
+            # saltem blancs i separadors ([ , ]) fins al proper objecte
+            while pos < len(buf) and buf[pos] in " \t\r\n[,":
+                pos += 1
+            if pos >= len(buf):
+                break
+            if buf[pos] == "]":
+                closed = True
+                break
+            try:
+                record, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # objecte incomplet: esperem el proper tros
+                break
+            yield record
+    if not closed and buf[pos:].strip():
+        raise ValueError("truncated JSON response")
+
+
+class RecordBuffer:
+    # columnes tipades que creixen per duplicacio: codi_eoi i contaminant es guarden com a index (int16)
+    def __init__(self, stations, contaminants, capacity = 1024):
+        self.stations = list(stations)
+        self.contaminants = list(contaminants)
+        self.istation = {codi: i for i, codi in enumerate(self.stations)}
+        self.icontaminant = {nom: i for i, nom in enumerate(self.contaminants)}
+        self.n = 0
+        self.columns = {
+            "codi_eoi": np.empty(capacity, dtype=np.int16),
+            "contaminant": np.empty(capacity, dtype=np.int16),
+            "data": np.empty(capacity, dtype="datetime64[D]"),
+            "lon": np.empty(capacity, dtype=np.float64),
+            "lat": np.empty(capacity, dtype=np.float64),
+            "hores": np.empty((capacity, len(HORES)), dtype=np.float32),
+            }
+
+    def _grow(self):
+        for key, column in self.columns.items():
+            grown = np.empty((max(1, 2 * len(column)),) + column.shape[1:], dtype=column.dtype)
+            grown[:self.n] = column[:self.n]
+            self.columns[key] = grown
+
+    def append(self, record):
+        # retorna False (i no desa res) si el registre no es d'una estacio o contaminant que ens interessi
+        istation = self.istation.get(record.get("codi_eoi"))
+        icontaminant = self.icontaminant.get(record.get("contaminant"))
+        if istation is None or icontaminant is None:
+            return False
+        if self.n == len(self.columns["codi_eoi"]):
+            self._grow()
+        i, c = self.n, self.columns
+        c["codi_eoi"][i] = istation
+        c["contaminant"][i] = icontaminant
+        c["data"][i] = record["data"][:10] if "data" in record else "NaT"
+        c["lon"][i] = record.get("longitud", record.get("lon", np.nan))
+        c["lat"][i] = record.get("latitud", record.get("lat", np.nan))
+        c["hores"][i] = [record.get(h, np.nan) for h in HORES]
+        self.n += 1
+        return True
+
+    def to_frame(self):
+        # directament amb l'esquema de normalize_data: els index ja son els codis de les categories
+        c, n = self.columns, self.n
+        codi_eoi = pd.Categorical.from_codes(c["codi_eoi"][:n], categories=self.stations)
+        contaminant = pd.Categorical.from_codes(c["contaminant"][:n], categories=self.contaminants)
+        columns = {
+            "codi_eoi": codi_eoi,
+            "data": c["data"][:n].astype("datetime64[s]"),
+            "contaminant": contaminant,
+            "lon": c["lon"][:n].astype(np.float32),
+            "lat": c["lat"][:n].astype(np.float32),
+            }
+        columns.update(zip(HORES, c["hores"][:n].T))
+        columns["eoi_id"] = get_positions(ESTACIONS["codi_eoi"], pd.Series(codi_eoi)).astype(np.int8)
+        columns["contaminant_id"] = get_positions(CONTAMINANTS["nom"], pd.Series(contaminant)).astype(np.int8)
+        return pd.DataFrame(columns)
+
+
+def read_data_stream(url, stations = None, contaminants = None, session = SESSION):
+    # com read_data, pero llegint en streaming i quedant-nos nomes amb les estacions i contaminants indicats
+    buffer = RecordBuffer(ESTACIONS["codi_eoi"] if stations is None else stations, 
+                          CONTAMINANTS["nom"] if contaminants is None else contaminants)
+    # descarrega i parse van intercalats: es mesuren junts
+    with span("socrata.stream"):
+        for record in iter_records(session.iter_content(url)):
+            buffer.append(record)
+        return buffer.to_frame()
+
+
+def get_count(where, session = SESSION):
+    # nombre de registres que compleixen els predicats
+    rows = json.loads(session.get(get_query(where=where, select=["count(*) AS n"])))
+    return int(rows[0]["n"]) if rows else 0
+
+# cache local de les dades descarregades (es crea la primera vegada que es necessita)
+CACHE = None
+
+def get_cache():
+    global CACHE
+    if CACHE is None:
+        CACHE = DataCache()
+    return CACHE
+
+
 # ---------------------------------------------------------------------------------------------------------------------
-def get_all_EOI_data(ymd):
+def get_all_EOI_data(ymd, use_cache = True):
+    # obtenim les dades de tots els contaminants i de totes les estacions del projecte per una data determinada
+    # els dies tancats es serveixen des de la cache local; el dia d'avui es torna a demanar passat el TTL
+    if use_cache:
+        return get_cache().get_or_fetch(ymd, fetch_all_EOI_data)
+    return fetch_all_EOI_data(ymd)
+
+
+def invalidate_EOI_data(ymd = None, contaminants = None, codis = None):
+    # esborrem de la cache una data (o tota la cache si ymd es None), amb totes les seves claus: el dia sencer
+    # (get_all_EOI_data) i les consultes de get_risk_data
+    # amb contaminants, nomes les consultes de get_risk_data d'aquests contaminants i estacions (per defecte, totes)
+    if contaminants is None or ymd is None:
+        get_cache().invalidate(ymd)
+        return
+    for contaminante in contaminants:
+        get_cache().invalidate(ymd, clau=get_risk_query(ymd, codis, contaminante))
+
+
+def warm_EOI_data(dates, contaminants = ('NO2',), codis = None):
+    # precarreguem a la cache les dates indicades, tant el dia sencer (get_all_EOI_data) com les consultes de
+    # get_risk_data dels contaminants i estacions (per defecte, totes) que llegeix l'app
+    # retorna les dates que s'han hagut de descarregar (d'alguna de les claus)
+    cache = get_cache()
+    fetched = cache.warm(dates, fetch_all_EOI_data)
+    for ymd in dates:
+        for contaminante in contaminants or []:
+            url = get_risk_query(ymd, codis, contaminante)
+            fetched += cache.warm([ymd], lambda ymd: read_data(url), clau=url)
+    return list(dict.fromkeys(fetched))
+
+
+def fetch_all_EOI_data(ymd):
     # obtenim les dades en json de tots els contaminants i de totes les estacions per una data determinada
-    df = pd.read_json(f"{URL_DATA}$where=data='{ymd}T00:00:00.000'", orient='records')
+    df = read_data(get_query(where=[where_date(ymd)]))
     if df.empty: 
         return df
     else:
@@ -35,22 +298,75 @@ def get_all_EOI_data(ymd):
 
 
 # ---------------------------------------------------------------------------------------------------------------------
-def get_contaminant_data(ymd, contaminante = 'NO2'):
+def get_risk_query(ymd, codis = None, contaminante = 'NO2'):
+    # filtrem al servidor (SoQL) per data, estacions i contaminant, i nomes demanem les columnes del calcul del risc
+    # la url es tambe la clau de la cache
+    codis = ESTACIONS["codi_eoi"] if codis is None else codis
+    return get_query(where=[where_date(ymd), where_in("codi_eoi", codis), where_in("contaminant", [contaminante])], 
+                     select=SELECT_RISK)
+
+
+def get_risk_data(ymd, codis, contaminante = 'NO2', use_cache = True):
+    url = get_risk_query(ymd, codis, contaminante)
+    if use_cache:
+        return get_cache().get_or_fetch(ymd, lambda ymd: read_data(url), clau=url)
+    return read_data(url)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def get_contaminant_data(ymd, contaminante = 'NO2', use_cache = True):
     # obtenim les dades d'un contaminant per a totes les les estacions del projecte en una data determinada
-    df = get_all_EOI_data(ymd)
-    if df.empty: 
-        return df
-    else:
-        return df[df.contaminant.eq(contaminante)]
+    return get_risk_data(ymd, ESTACIONS["codi_eoi"], contaminante, use_cache)
 
 
 # ---------------------------------------------------------------------------------------------------------------------
-def get_data(ymd, nom_eoi, contaminante = 'NO2'):
-    df = get_contaminant_data(ymd, contaminante)
-    if df.empty:
-        return df
-    else:
-        return df[df.nom_estacio.eq(nom_eoi)]
+def get_data(ymd, nom_eoi, contaminante = 'NO2', use_cache = True):
+    codis = [c for c, n in zip(ESTACIONS["codi_eoi"], ESTACIONS["nom_eoi"]) if n == nom_eoi]
+    if not codis:
+        return pd.DataFrame()
+    return get_risk_data(ymd, codis, contaminante, use_cache)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def get_range(start, end, contaminants = None, stations = None, select = None, workers = 4, session = SESSION, stream = False):
+    # obtenim totes les dades d'un interval de dates [start, end] amb una sola consulta paginada ($limit/$offset)
+    # contaminants ... llista de noms (None: tots)
+    # stations     ... llista de codi_eoi (None: totes les estacions del projecte)
+    # stream       ... lectura en streaming a columnes tipades (codi_eoi, data, contaminant, lon, lat, h01..h24)
+    where = [where_between(start, end), where_in("codi_eoi", stations or ESTACIONS["codi_eoi"])]
+    if contaminants:
+        where.append(where_in("contaminant", contaminants))
+    if stream:
+        read = lambda url: read_data_stream(url, stations, contaminants, session)
+        return get_paged(where, select, workers, session, read)
+    return get_paged(where, select, workers, session)
+
+
+def get_paged(where, select = None, workers = 4, session = SESSION, read = None):
+    # consulta paginada ($limit/$offset) de tots els registres que compleixen els predicats de where
+    # read(url) -> DataFrame llegeix cada pagina (per defecte, read_data)
+    read = read or (lambda url: read_data(url, session))
+
+    # l'ordre ha de ser estable perque les pagines no se solapin
+    def page(offset):
+        url = get_query(where=where, select=select, order="data,codi_eoi,contaminant,:id", limit=DATA_LIMIT, offset=offset)
+        return read(url)
+
+    # sabent el total, demanem totes les pagines alhora
+    count = get_count(where, session)
+    offsets = list(range(0, count, DATA_LIMIT))
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(offsets)))) as executor:
+        frames = list(executor.map(page, offsets))
+    # si mentrestant s'han afegit registres, l'ultima pagina sera plena: continuem fins a una pagina incompleta
+    while frames and len(frames[-1]) == DATA_LIMIT:
+        frames.append(page(DATA_LIMIT * len(frames)))
+
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    # les categories de cada pagina son diferents i concat les torna a text: es tornen a normalitzar
+    df = pd.concat(frames, ignore_index=True)
+    return normalize_data(df.rename(columns={'latitud':'lat', 'longitud':'lon'}))
 
 
 def get_CM(df):
@@ -63,3 +379,66 @@ def get_CM(df):
         
 # ---------------------------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari: servidor local que fa de Socrata i retorna el que se li demana
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import json
+    import threading
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            self.server.queries.append(query)
+            row = {"codi_eoi": "08019043", "lon": "2.1537998", "lat": "41.385315", "h01": "45", "h02": "51"}
+            if "$select" not in query:
+                # el dia sencer porta totes les columnes del dataset
+                row["nom_estacio"] = "Barcelona (Eixample)"
+            body = json.dumps([row])
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), StubHandler)
+    server.queries = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    URL_DATA = f"http://127.0.0.1:{server.server_port}/resource/{DATA_ID}.json?"
+
+    df = get_data("2022-05-01", "Barcelona (Eixample)", 'NO2', use_cache=False)
+    query = server.queries[-1]
+    print(f"$where: {query['$where'][0]}")
+    print(f"$select: {query['$select'][0]}")
+    print(f"codi_eoi: {df.codi_eoi.iloc[0]} | 08019043")
+    assert query['$where'][0] == "data='2022-05-01T00:00:00.000' AND codi_eoi in('08019043') AND contaminant in('NO2')"
+    assert query['$select'][0] == ",".join(SELECT_RISK)
+    assert list(df.columns) == ["codi_eoi", "lon", "lat", "h01", "h02", "eoi_id"]
+    assert df.codi_eoi.iloc[0] == "08019043" and df.h01.iloc[0] == 45
+
+    # sense cap estacio no es fa cap consulta
+    n = len(server.queries)
+    assert get_data("2022-05-01", "no existeix", 'NO2', use_cache=False).empty
+    assert len(server.queries) == n
+
+    # warm_EOI_data omple tambe les claus de get_risk_data: l'app ja no torna a consultar el servidor
+    import tempfile
+    CACHE = DataCache(os.path.join(tempfile.mkdtemp(), "cache.sqlite"))
+    warm_EOI_data(["2022-05-01"])
+    n = len(server.queries)
+    get_contaminant_data("2022-05-01", 'NO2')
+    print(f"queries after warm: {len(server.queries) - n} | 0")
+    assert len(server.queries) == n
+    invalidate_EOI_data("2022-05-01", ['NO2'])
+    get_contaminant_data("2022-05-01", 'NO2')
+    print(f"queries after invalidate: {len(server.queries) - n} | 1")
+    assert len(server.queries) == n + 1
+    assert server.queries[-1]['$where'][0] == " AND ".join([where_date("2022-05-01"), where_in("codi_eoi", ESTACIONS["codi_eoi"]),
+                                                            "contaminant in('NO2')"])
+    server.shutdown()
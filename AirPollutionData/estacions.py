@@ -1,23 +1,91 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-import pandas as pd
 
-from . import EOI_DF
+from . import ESTACIONS, EOI_DATA
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Columnes de EOI_DATA[codi_eoi]["LCZvsNO2_500M"] i EOI_DATA[codi_eoi]["POBLACION_500M"]
+LCZ_COLUMNS = ["NO2", "LCZ_1", "LCZ_2", "LCZ_3", "LCZ_4", "LCZ_5", "LCZ_6", "LCZ_7", "LCZ_8", "LCZ_9", "LCZ_10", 
+               "LCZ_A", "LCZ_B", "LCZ_C", "LCZ_D", "LCZ_E", "LCZ_F", "LCZ_G", "T_LCZ"]
+POBLACION_COLUMNS = ["TOTAL", "HOMES", "DONES", "P_0_14", "P_15_64", "P_65_I_MES", 
+                     "P_ESPANYOL", "P_ESTRANGE", "P_NASC_CAT", "P_NASC_RES", "P_NASC_EST"]
+
+# offsets de cada columna dins de les matrius del registre
+LCZ_COL = {nom: i for i, nom in enumerate(LCZ_COLUMNS)}
+POBLACION_COL = {nom: i for i, nom in enumerate(POBLACION_COLUMNS)}
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Registre d'estacions: index (diccionaris) per codi, nom i etiqueta, i les dades de EOI_DATA com a matrius
+# contigues (una fila per estacio, en el mateix ordre que ESTACIONS).
+# ---------------------------------------------------------------------------------------------------------------------
+class StationRegistry:
+    def __init__(self, estacions = ESTACIONS, eoi_data = EOI_DATA):
+        self.codi_eoi = list(estacions["codi_eoi"])
+        self.nom_eoi = list(estacions["nom_eoi"])
+        self.etiqueta = list(estacions["etiqueta"])
+        self.lon = np.array(estacions["lon"], dtype=float)
+        self.lat = np.array(estacions["lat"], dtype=float)
+
+        self.by_codi = {codi: i for i, codi in enumerate(self.codi_eoi)}
+        self.by_nom = {nom: i for i, nom in enumerate(self.nom_eoi)}
+        self.by_etiqueta = {etiqueta: i for i, etiqueta in enumerate(self.etiqueta)}
+
+        # les estacions sense dades a EOI_DATA queden amb una fila de NaN
+        self.lcz = np.full((len(self.codi_eoi), len(LCZ_COLUMNS)), np.nan)
+        self.poblacion = np.full((len(self.codi_eoi), len(POBLACION_COLUMNS)), np.nan)
+        for i, codi in enumerate(self.codi_eoi):
+            data = eoi_data.get(codi, {})
+            if data.get("LCZvsNO2_500M"):
+                self.lcz[i] = data["LCZvsNO2_500M"]
+            if data.get("POBLACION_500M"):
+                self.poblacion[i] = data["POBLACION_500M"]
+
+    def __len__(self):
+        return len(self.codi_eoi)
+
+    def index(self, codi):
+        # fila de l'estacio (None si no existeix)
+        return self.by_codi.get(codi)
+
+    def indices(self, codis):
+        # files d'una llista d'estacions (-1 si no existeix)
+        return np.array([self.by_codi.get(codi, -1) for codi in codis], dtype=np.intp)
+
+    def get_lcz(self, codi, columna):
+        i = self.by_codi.get(codi)
+        return np.nan if i is None else self.lcz[i, LCZ_COL[columna]]
+
+    def get_poblacion(self, codi, columna):
+        i = self.by_codi.get(codi)
+        return np.nan if i is None else self.poblacion[i, POBLACION_COL[columna]]
+
+
+REGISTRY = StationRegistry()
+
 
 # ---------------------------------------------------------------------------------------------------------------------
 def get_nom_eoi(codi):
-    df = EOI_DF[EOI_DF.codi_eoi == codi]
-    if df.shape[0] == 1:
-        return df['nom_eoi'].iloc[0]
+    i = REGISTRY.by_codi.get(codi)
+    if i is not None:
+        return REGISTRY.nom_eoi[i]
     else:
         return f"None"
 
 
 def get_codi_eoi(nom):
-    df = EOI_DF[EOI_DF.nom_eoi == nom]
-    if df.shape[0] == 1:
-        return df['codi_eoi'].iloc[0]
+    i = REGISTRY.by_nom.get(nom)
+    if i is not None:
+        return REGISTRY.codi_eoi[i]
+    else:
+        return f"None"
+
+
+def get_etiqueta_codi_eoi(etiqueta):
+    i = REGISTRY.by_etiqueta.get(etiqueta)
+    if i is not None:
+        return REGISTRY.codi_eoi[i]
     else:
         return f"None"
 
@@ -27,6 +95,6 @@ def get_codi_eoi(nom):
 # ---------------------------------------------------------------------------------------------------------------------
 if __name__ == '__main__':
     nom = get_nom_eoi('08101001')
-    print(f"{codi} -> {nom}")
+    print(f"08101001 -> {nom}")
     codi = get_codi_eoi(nom)
-    print(f"{nom} -> {codi}")
\ No newline at end of file
+    print(f"{nom} -> {codi}")
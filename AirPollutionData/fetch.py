@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import zlib
+import time
+import random
+import threading
+import http.client
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Capa de descarrega HTTP:
+#  - connexions keep-alive reutilitzades (una per fil i servidor: http.client no es thread-safe)
+#  - timeouts separats de connexio i de lectura
+#  - reintents limitats amb backoff exponencial (amb jitter) per errors de xarxa, 429 i 5xx
+#  - circuit breaker per servidor: despres de BREAKER_THRESHOLD errors seguits, deixem de demanar-hi
+#    durant BREAKER_RESET segons i fallem de seguida (la cache servira l'ultima resposta bona)
+# ---------------------------------------------------------------------------------------------------------------------
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+RETRIES = 2
+BACKOFF = 0.5
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30
+
+# codis HTTP que val la pena tornar a provar
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# errors que indiquen que el servidor ha tancat la connexio keep-alive: es torna a obrir i es repeteix
+RECONNECT_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, http.client.BadStatusLine,
+                    ConnectionResetError, BrokenPipeError)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+class CircuitBreaker:
+    def __init__(self, threshold = BREAKER_THRESHOLD, reset = BREAKER_RESET):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened >= self.reset:
+                # mig obert: deixem passar una sola peticio de prova i tornem a comptar el temps
+                self.opened = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.monotonic()
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+class Session:
+    def __init__(self, timeout = (CONNECT_TIMEOUT, READ_TIMEOUT), retries = RETRIES, backoff = BACKOFF,
+                 breaker_threshold = BREAKER_THRESHOLD, breaker_reset = BREAKER_RESET):
+        # timeout: segons, o una tupla (connexio, lectura)
+        self.connect_timeout, self.read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _connections(self):
+        if not hasattr(self.local, "conns"):
+            self.local.conns = {}
+        return self.local.conns
+
+    def _connection(self, scheme, netloc):
+        conns = self._connections()
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self.connect_timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self.connect_timeout)
+            conns[(scheme, netloc)] = conn
+        if conn.sock is None:
+            # connectem amb el timeout de connexio i, un cop connectats, passem al de lectura
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _discard(self, scheme, netloc):
+        conn = self._connections().pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def breaker(self, netloc):
+        with self.lock:
+            if netloc not in self.breakers:
+                self.breakers[netloc] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            return self.breakers[netloc]
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def _open_once(self, url, headers = None):
+        # envia la peticio i retorna la resposta amb el cos encara per llegir
+        parts = urlsplit(url)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        request_headers = {"Accept": "application/json", "Accept-Encoding": "gzip"}
+        request_headers.update(headers or {})
+        for intent in (0, 1):
+            try:
+                conn = self._connection(parts.scheme, parts.netloc)
+                conn.request("GET", path, headers=request_headers)
+                resp = conn.getresponse()
+            except RECONNECT_ERRORS:
+                self._discard(parts.scheme, parts.netloc)
+                if intent:
+                    raise
+                continue
+            except Exception:
+                self._discard(parts.scheme, parts.netloc)
+                raise
+            if resp.status >= 400:
+                resp.read()
+                raise HTTPError(url, resp.status, resp.reason, resp.headers, None)
+            return resp
+
+    def _get_once(self, url, headers = None):
+        resp = self._open_once(url, headers)
+        try:
+            body = resp.read()
+        except Exception:
+            self._discard(*urlsplit(url)[:2])
+            raise
+        if resp.getheader("Content-Encoding", "") == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def _retry(self, url, request):
+        # request() amb reintents i circuit breaker
+        breaker = self.breaker(urlsplit(url).netloc)
+        if not breaker.allow():
+            raise CircuitOpenError(f"circuit open for {urlsplit(url).netloc}")
+        for intent in range(self.retries + 1):
+            try:
+                result = request()
+            except HTTPError as e:
+                if e.code not in RETRY_STATUS:
+                    # el servidor respon: l'error es de la consulta, no de disponibilitat
+                    breaker.success()
+                    raise
+                error = e
+            except (OSError, http.client.HTTPException) as e:
+                # timeouts, connexions refusades, respostes tallades...
+                error = e
+            else:
+                breaker.success()
+                return result
+            if intent < self.retries:
+                time.sleep(self.backoff * 2**intent * random.uniform(0.5, 1.0))
+        breaker.failure()
+        raise error
+
+    def get(self, url, headers = None):
+        # retorna el cos de la resposta (bytes); els errors HTTP es llancen com a HTTPError (com urlopen)
+        return self._retry(url, lambda: self._get_once(url, headers))
+
+    def iter_content(self, url, headers = None, chunk_size = 65536):
+        # cos de la resposta a trossos (bytes ja descomprimits), sense tenir-lo mai sencer a memoria.
+        # Nomes es reintenta fins a tenir la capcalera: un error a mig cos es propaga.
+        resp = self._retry(url, lambda: self._open_once(url, headers))
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if resp.getheader("Content-Encoding", "") == "gzip" else None
+        complete = False
+        try:
+            while True:
+                chunk = resp.read(chunk_size)
+                if not chunk:
+                    break
+                yield decompressor.decompress(chunk) if decompressor else chunk
+            if decompressor:
+                yield decompressor.flush()
+            complete = True
+        finally:
+            if not complete:
+                # la connexio te bytes pendents: no es pot reutilitzar
+                self._discard(*urlsplit(url)[:2])
+
+    def close(self):
+        for key in list(self._connections()):
+            self._discard(*key)
+
+
+# sessio compartida per tot el paquet
+SESSION = Session()
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari: servidor local que injecta errors (503) i respostes lentes
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class FaultHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.server.requests += 1
+            if self.path.startswith("/slow"):
+                time.sleep(1.0)
+            status = 503 if self.server.requests <= self.server.failures else 200
+            body = b"[]"
+            try:
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except BrokenPipeError:
+                # el client ja ha desistit (timeout de lectura)
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FaultHandler)
+    server.requests, server.failures = 0, 2
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    session = Session(timeout=(1, 0.2), retries=2, backoff=0.01, breaker_threshold=2, breaker_reset=0.5)
+    body = session.get(url + '/ok')
+    print(f"two 503 then 200: {body} after {server.requests} requests | b'[]' after 3 requests")
+    assert body == b"[]" and server.requests == 3
+
+    # lectura lenta: cada get() fa 1 + retries intents i acaba en timeout; el segon obre el circuit
+    for i in range(2):
+        n = server.requests
+        try:
+            session.get(url + "/slow")
+        except OSError as e:
+            print(f"slow response: {type(e).__name__} after {server.requests - n} requests | TimeoutError after 3 requests")
+            assert isinstance(e, TimeoutError) and server.requests - n == 3
+        else:
+            raise AssertionError("slow response did not time out")
+    breaker = session.breaker(urlsplit(url).netloc)
+    assert breaker.is_open
+
+    # circuit obert: es falla de seguida, sense arribar al servidor
+    n = server.requests
+    try:
+        session.get(url + "/ok")
+    except CircuitOpenError as e:
+        print(f"after 2 failures: {e}")
+    else:
+        raise AssertionError("circuit did not open")
+    assert server.requests == n
+
+    # passat breaker_reset, una peticio de prova; si falla, el circuit es torna a obrir
+    time.sleep(0.5)
+    server.failures = server.requests + 3
+    try:
+        session.get(url + "/ok")
+    except HTTPError as e:
+        assert e.code == 503
+    assert breaker.is_open and server.requests == n + 3
+    try:
+        session.get(url + "/ok")
+        raise AssertionError("circuit did not reopen after a failed probe")
+    except CircuitOpenError:
+        pass
+
+    # si la prova va be, el circuit es tanca
+    time.sleep(0.5)
+    assert session.get(url + "/ok") == b"[]"
+    print(f"probe after breaker_reset: open {breaker.is_open}, failures {breaker.failures} | open False, failures 0")
+    assert not breaker.is_open and breaker.failures == 0
+    assert session.get(url + "/ok") == b"[]"
+    server.shutdown()
+
+    # mig obert: nomes passa una peticio de prova fins que se'n sap el resultat
+    breaker = CircuitBreaker(threshold=1, reset=0.1)
+    breaker.failure()
+    assert not breaker.allow()
+    time.sleep(0.1)
+    assert breaker.allow() and not breaker.allow()
+    breaker.success()
+    assert breaker.allow() and not breaker.is_open
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import warnings
+
 import numpy as np
-import pandas as pd
 
-from . import dades_obertes
+# pandas i dades_obertes nomes els necessiten les funcions que treballen amb DataFrames: s'importen alla,
+# perque un proces que nomes fa servir get_VUCI o get_scenario no hagi de carregar pandas.
 
 # ---------------------------------------------------------------------------------------------------------------------
 LCZ_NAME = {
@@ -81,6 +83,28 @@ def get_VUCI(lcz):
     return VUCI.get(lcz, 0)
 
 
+# ---------------------------------------------------------------------------------------------------------------------
+# Versio vectoritzada: les LCZ es codifiquen com a enters (posicio a LCZ_KEYS, -1 si es desconeguda)
+# i el VUCI surt d'una taula indexada per aquest codi. L'ultima posicio (codi -1) val 0, com VUCI.get(lcz, 0).
+LCZ_KEYS = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', 'A', 'B', 'C', 'D', 'E', 'F', 'G']
+LCZ_CODE = {lcz: i for i, lcz in enumerate(LCZ_KEYS)}
+VUCI_TABLE = np.array([VUCI[lcz] for lcz in LCZ_KEYS] + [0])
+
+
+def get_LCZ_code(lcz):
+    # lcz: str o llista/array de str -> int o array d'enters
+    if isinstance(lcz, str):
+        return LCZ_CODE.get(lcz, -1)
+    return np.array([LCZ_CODE.get(l, -1) for l in lcz], dtype=np.int8)
+
+
+def get_VUCI_array(lcz_code):
+    # lcz_code: array d'enters segons LCZ_KEYS (-1 o fora de rang: LCZ desconeguda, VUCI 0)
+    lcz_code = np.asarray(lcz_code)
+    lcz_code = np.where((lcz_code < 0) | (lcz_code >= len(LCZ_KEYS)), -1, lcz_code)
+    return VUCI_TABLE[lcz_code]
+
+
 # ---------------------------------------------------------------------------------------------------------------------
 # VUCI_CVP scenarios
 #
@@ -127,18 +151,56 @@ def get_scenario(vuci, cvp):
             return "A1", "Extremadamente vulnerable"
 
 
+# ---------------------------------------------------------------------------------------------------------------------
+# Versio vectoritzada de get_scenario: discretitzem VUCI i CVP amb els llindars de la taula (50, 60, 70)
+# i busquem l'escenari a una taula 4x4. np.digitize posa els NaN a l'ultim interval, igual que l'arbre
+# d'if/elif (qualsevol comparacio amb NaN es falsa).
+SCENARIO_THRESHOLDS = [50, 60, 70]
+SCENARIO_CODES = np.array(["A1", "A2", "B", "C1", "C2", "D"])
+SCENARIO_NAMES = np.array(["Extremadamente vulnerable", "Muy vulnerable", "Vulnerable", 
+                           "Vulnerable VUCI, poco vulnerable CVP", "Poco vulnerable VUCI, vulnerable CVP", "Poco vulnerable"])
+#                          cvp<50 50<cvp<60 60<cvp<70 70<cvp
+SCENARIO_TABLE = np.array([[5,     4,        4,        4],     # vuci<50     D  C2 C2 C2
+                           [3,     2,        2,        2],     # 50<vuci<60  C1 B  B  B
+                           [3,     2,        1,        1],     # 60<vuci<70  C1 B  A2 A2
+                           [3,     2,        1,        0]],    # 70<vuci     C1 B  A2 A1
+                          dtype=np.int8)
+
+
+def get_scenario_array(vuci, cvp):
+    # retorna el codi enter de l'escenari (index a SCENARIO_CODES / SCENARIO_NAMES)
+    ivuci = np.digitize(np.asarray(vuci, dtype=float), SCENARIO_THRESHOLDS)
+    icvp = np.digitize(np.asarray(cvp, dtype=float), SCENARIO_THRESHOLDS)
+    return SCENARIO_TABLE[ivuci, icvp]
+
+
 # ---------------------------------------------------------------------------------------------------------------------
 def get_hazard_data(contaminante, df):
     # df es el registre que conte els valors horaris del contaminant.
     # Aixo vol dir que df.shape[0] == 1
-    value_list = [ df[h].iloc[0]  if h in df.columns  else np.nan  for h in dades_obertes.HORES ]
-    return round(np.nanmedian(np.array(value_list)), 2)
+    # (les hores que no hi son, queden com a NaN)
+    from . import dades_obertes
+    values = df.reindex(columns=dades_obertes.HORES).iloc[0].to_numpy(dtype=float, na_value=np.nan)
+    return round(np.nanmedian(values), 2)
+
+
+def get_hazard_values(df):
+    # versio vectoritzada de get_hazard_data per a molts registres: una mediana per fila
+    from . import dades_obertes
+    values = df.reindex(columns=dades_obertes.HORES).to_numpy(dtype=float, na_value=np.nan)
+    with warnings.catch_warnings():
+        # les files sense cap valor horari donen NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.round(np.nanmedian(values, axis=1), 2)
 
 
 # ---------------------------------------------------------------------------------------------------------------------
 def get_df_histograma_hores(contaminante, df):
     # df es el registre que conte els valors horaris del contaminant.
     # Aixo vol dir que df.shape[0] == 1
+    import pandas as pd
+    from . import dades_obertes
+
     # calculem el valor mig del contaminant...
     v_mean = get_hazard_data(contaminante, df)
 
@@ -173,3 +235,22 @@ def get_df_histograma_hores(contaminante, df):
 # 'Huertos urbanos': ['B']
 # 'Zonas de vegetación herbácea': ['B']
 # ---------------------------------------------------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari: les versions vectoritzades han de donar el mateix que les escalars
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    values = np.append(np.arange(0, 120.25, 0.25), np.nan)
+    vuci, cvp = np.meshgrid(values, values, indexing='ij')
+    codes = get_scenario_array(vuci, cvp)
+    errors = sum(SCENARIO_CODES[codes[i, j]] != get_scenario(vuci[i, j], cvp[i, j])[0] or 
+                 SCENARIO_NAMES[codes[i, j]] != get_scenario(vuci[i, j], cvp[i, j])[1]
+                 for i in range(len(values)) for j in range(len(values)))
+    print(f"get_scenario_array vs get_scenario: {errors} differences in {codes.size} cases | 0")
+    assert errors == 0
+
+    lcz = LCZ_KEYS + ['none', '11']
+    errors = sum(get_VUCI_array(get_LCZ_code(lcz)) != np.array([get_VUCI(l) for l in lcz]))
+    print(f"get_VUCI_array vs get_VUCI: {errors} differences in {len(lcz)} cases | 0")
+    assert errors == 0
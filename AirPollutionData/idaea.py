@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-import pandas as pd
 import operator
 
 # ---------------------------------------------------------------------------------------------------------------------
@@ -10,33 +9,57 @@ import operator
 #                                         0   1     2     3     4     5     6     7     8     9     10     11    12    13    14    15    16    17    18
 # EOI_DATA[codi_eoi]["LCZvsNO2_500M"] = [NO2,LCZ_1,LCZ_2,LCZ_3,LCZ_4,LCZ_5,LCZ_6,LCZ_7,LCZ_8,LCZ_9,LCZ_10,LCZ_A,LCZ_B,LCZ_C,LCZ_D,LCZ_E,LCZ_F,LCZ_G,Total]
 
-from . import EOI_DATA
+from .estacions import REGISTRY, LCZ_COL
+from .icgc import LCZ_KEYS
+
 
 def get_NO2_2019(eoi_code):
-    dict = EOI_DATA.get(eoi_code, {})
-    llista = dict.get("LCZvsNO2_500M",[])
-    if llista:
-        return llista[0]
-    else:
-        return np.nan
+    return REGISTRY.get_lcz(eoi_code, "NO2")
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Composicio LCZ (%) de totes les estacions, calculada una sola vegada a partir de REGISTRY.lcz.
+# LCZ_PERCENT[i, j] = % de l'area del buffer de 500m de l'estacio i ocupada per la LCZ LCZ_KEYS[j]
+# Les estacions sense dades queden amb una fila de NaN i LCZ dominant "none" (codi -1).
+def get_LCZ_percent_matrix(lcz):
+    area = lcz[:, LCZ_COL["LCZ_1"]:LCZ_COL["LCZ_G"] + 1]
+    total = lcz[:, LCZ_COL["T_LCZ"]][:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.round(100.0 * area / total, 2)
+
+
+LCZ_PERCENT = get_LCZ_percent_matrix(REGISTRY.lcz)
+LCZ_HAS_DATA = ~np.isnan(LCZ_PERCENT).all(axis=1)
+# en cas d'empat ens quedem amb la primera LCZ, igual que max(dict, key=dict.get)
+LCZ_ARGMAX = np.where(LCZ_HAS_DATA, np.argmax(np.nan_to_num(LCZ_PERCENT, nan=-1.0), axis=1), -1)
+LCZ_DICTS = [dict(zip(LCZ_KEYS, row.tolist())) if ok else {} for row, ok in zip(LCZ_PERCENT, LCZ_HAS_DATA)]
 
 
 def get_LCZmax(eoi_code):
-    lcz_keys = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', 'A', 'B', 'C', 'D', 'E', 'F', 'G']
     # anem a obtenir la informacio associada a les LCZs dins d'un buffer de 500m de l'estacio
-    dict = EOI_DATA.get(eoi_code, {})
-    llista = dict.get("LCZvsNO2_500M",[])
-    if llista:
-        total = float(llista[18])
-        dict = {}
-        for iP, value in enumerate(lcz_keys):
-            dict[value] = round(100*float(llista[iP+1])/total, 2)
-        # retornem la key (LCZ) associada que ocupa mes area en el buffer...
-        return dict, max(dict, key=dict.get)
+    i = REGISTRY.index(eoi_code)
+    if i is not None and LCZ_HAS_DATA[i]:
+        # retornem el diccionari {lcz:%} i la key (LCZ) associada que ocupa mes area en el buffer...
+        return dict(LCZ_DICTS[i]), LCZ_KEYS[LCZ_ARGMAX[i]]
     else:
         return {}, "none"
 
 
+def get_LCZmax_code(eoi_codes):
+    # versio per lots: codi enter (posicio a LCZ_KEYS, -1 sense dades) de la LCZ dominant de cada estacio
+    i = REGISTRY.indices(eoi_codes)
+    return np.where(i >= 0, LCZ_ARGMAX[i], -1)
+
+
+def get_LCZ_topk(eoi_codes, k = 3):
+    # les k LCZ dominants de cada estacio: (codis enters [n, k], percentatges [n, k]), ordenades de mes a menys area
+    i = REGISTRY.indices(eoi_codes)
+    percent = np.where((i >= 0)[:, None], LCZ_PERCENT[i], np.nan)
+    order = np.argsort(-np.nan_to_num(percent, nan=-1.0), axis=1, kind="stable")[:, :k]
+    top = np.take_along_axis(percent, order, axis=1)
+    return np.where(np.isnan(top), -1, order), top
+
+
 if __name__ == '__main__': 
      #  LCZ | m2            |     %
      #    1 |      0        |  0.0
@@ -1,9 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-import pandas as pd
 
-from . import EOI_DATA
+from .estacions import REGISTRY, POBLACION_COL
 
 
 # buffer_poblacion_500m.csv
@@ -20,14 +19,15 @@ def get_CVP(eoi_code, iP = 1):
     #
     # 2. Index d'envelliment (IDESCAT). Poblacio de 65 anys i mes per cada 100 habitants de menys de 15 anys.
     
-    dict = EOI_DATA.get(eoi_code, {})
-    llista = dict.get("POBLACION_500M", [])
-    if not llista: return np.nan
+    i = REGISTRY.index(eoi_code)
+    if i is None: return np.nan
     
     # comprovem que hem trobat les dades associades a l'estacio. 
-    total = float(llista[0])
-    p_0_14 = float(llista[3])
-    p_65 = float(llista[5])
+    row = REGISTRY.poblacion[i]
+    if np.isnan(row[POBLACION_COL["TOTAL"]]): return np.nan
+    total = float(row[POBLACION_COL["TOTAL"]])
+    p_0_14 = float(row[POBLACION_COL["P_0_14"]])
+    p_65 = float(row[POBLACION_COL["P_65_I_MES"]])
 
     if iP == 1:
         return round(100.0 * p_65 / total, 2)
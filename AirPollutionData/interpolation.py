@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import io
+import base64
+import functools
+
+import numpy as np
+
+from . import ESTACIONS
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Interpolacio espacial dels valors diaris de les estacions (hazard de NO2...) sobre una graella que cobreix
+# el rectangle de les estacions.
+#
+# Els pesos nomes depenen de la graella i de les estacions, no dels valors: es calculen una sola vegada
+# (W[cel.les, estacions]) i cada dia nou es un producte matriu-vector, grid = W @ valors.
+#   idw     ... inverse distance weighting: w = 1 / d^power, normalitzats per cel.la
+#   kriging ... kriging ordinari amb un variograma exponencial fix (nugget, sill, range en km)
+# Si falten estacions (NaN), es fan servir els pesos calculats sense aquestes estacions (tambe en cache per mascara).
+# ---------------------------------------------------------------------------------------------------------------------
+EARTH_RADIUS = 6371.0088
+
+GRID_SIZE = (120, 100)           # (nx, ny)
+GRID_MARGIN = 0.05               # marge al voltant de les estacions (graus)
+IDW_POWER = 2.0
+VARIOGRAM = (0.0, 1.0, 8.0)      # nugget, sill, range (km)
+MAX_DISTANCE = 12.0              # km: mes enlla de l'estacio mes propera la cel.la es transparent
+
+# rampa de colors (valor, r, g, b): verd - groc - vermell, amb els llindars del semafor (30, 40) al mig
+COLOR_RAMP = [(0, 0, 200, 0), (30, 255, 255, 0), (40, 255, 150, 0), (60, 255, 0, 0)]
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    # distancia (km) sobre l'esfera; accepta arrays i fa broadcasting
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(x, dtype=float)) for x in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def get_bounds(lon, lat, margin = GRID_MARGIN):
+    # [oest, sud, est, nord], com el bounds de BitmapLayer
+    return [float(np.min(lon)) - margin, float(np.min(lat)) - margin, float(np.max(lon)) + margin, float(np.max(lat)) + margin]
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+class InterpolationGrid:
+    def __init__(self, codis = None, size = GRID_SIZE, bounds = None, method = "idw", power = IDW_POWER, variogram = VARIOGRAM):
+        codis = list(ESTACIONS["codi_eoi"] if codis is None else codis)
+        index = [ESTACIONS["codi_eoi"].index(codi) for codi in codis]
+        self.codis = codis
+        self.station_lon = np.array([ESTACIONS["lon"][i] for i in index])
+        self.station_lat = np.array([ESTACIONS["lat"][i] for i in index])
+        self.bounds = bounds or get_bounds(self.station_lon, self.station_lat)
+        self.nx, self.ny = size
+        self.method = method
+        self.power = power
+        self.variogram = variogram
+
+        # centres de les cel.les; la fila 0 es la del sud
+        self.lon = np.linspace(self.bounds[0], self.bounds[2], self.nx)
+        self.lat = np.linspace(self.bounds[1], self.bounds[3], self.ny)
+        lon, lat = np.meshgrid(self.lon, self.lat)
+        self.distances = haversine(lon.ravel()[:, None], lat.ravel()[:, None], self.station_lon, self.station_lat)
+        self.nearest = self.distances.min(axis=1).reshape(self.ny, self.nx)
+        self.weights = {}
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def _idw(self, valid):
+        d = self.distances[:, valid]
+        with np.errstate(divide="ignore"):
+            w = 1.0 / d**self.power
+        # una cel.la just sobre una estacio en pren el valor
+        exact = d == 0
+        w = np.where(exact.any(axis=1, keepdims=True), exact.astype(float), w)
+        return w / w.sum(axis=1, keepdims=True)
+
+    def _gamma(self, h):
+        nugget, sill, rang = self.variogram
+        return np.where(h > 0, nugget + (sill - nugget) * (1.0 - np.exp(-3.0 * h / rang)), 0.0)
+
+    def _kriging(self, valid):
+        # sistema de kriging ordinari [gamma 1; 1 0] [lambda; mu] = [gamma0; 1], resolt per a totes les cel.les alhora
+        lon, lat = self.station_lon[valid], self.station_lat[valid]
+        n = len(lon)
+        a = np.ones((n + 1, n + 1))
+        a[:n, :n] = self._gamma(haversine(lon[:, None], lat[:, None], lon, lat))
+        a[n, n] = 0.0
+        b = np.ones((n + 1, len(self.distances)))
+        b[:n] = self._gamma(self.distances[:, valid]).T
+        return np.linalg.solve(a, b)[:n].T
+
+    def get_weights(self, valid = None):
+        # W[cel.les, estacions valides] per a la mascara d'estacions amb valor (calculada una vegada per mascara)
+        valid = np.ones(len(self.codis), dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+        key = valid.tobytes()
+        if key not in self.weights:
+            self.weights[key] = self._kriging(valid) if self.method == "kriging" else self._idw(valid)
+        return self.weights[key]
+
+    def interpolate(self, values):
+        # values: valor de cada estacio (alineat amb codis, NaN si no n'hi ha) -> graella [ny, nx]
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        if not valid.any():
+            return np.full((self.ny, self.nx), np.nan)
+        return (self.get_weights(valid) @ values[valid]).reshape(self.ny, self.nx)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_interpolation_grid(codis, size, method):
+    return InterpolationGrid(None if codis is None else list(codis), size, method=method)
+
+
+def get_interpolation_grid(codis = None, size = GRID_SIZE, method = "idw"):
+    # una graella per combinacio d'estacions, mida i metode (els pesos es reaprofiten entre dies i sessions)
+    return _get_interpolation_grid(None if codis is None else tuple(codis), size, method)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def get_rgba(grid, nearest = None, max_distance = MAX_DISTANCE, alpha = 140, ramp = COLOR_RAMP):
+    # graella de valors [ny, nx] -> imatge RGBA uint8 amb la fila 0 al nord (NaN i cel.les llunyanes, transparents)
+    stops = np.array([s[0] for s in ramp], dtype=float)
+    rgba = np.zeros(grid.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        rgba[..., channel] = np.interp(np.nan_to_num(grid), stops, [s[channel + 1] for s in ramp])
+    visible = ~np.isnan(grid)
+    if nearest is not None:
+        visible &= nearest <= max_distance
+    rgba[..., 3] = np.where(visible, alpha, 0)
+    return rgba[::-1]
+
+
+def get_png_data_uri(rgba):
+    # la BitmapLayer de pydeck accepta la imatge com a data URI (Pillow ja ve amb streamlit)
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, "RGBA").save(buffer, format="PNG", optimize=True)
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def get_interpolation_image(values, codis = None, method = "idw", size = GRID_SIZE):
+    # valors de les estacions -> (data URI PNG, bounds) per a pdk.Layer("BitmapLayer", image=..., bounds=...)
+    grid = get_interpolation_grid(codis, size, method)
+    rgba = get_rgba(grid.interpolate(values), grid.nearest)
+    return get_png_data_uri(rgba), grid.bounds
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(0)
+    values = rng.uniform(10, 60, len(ESTACIONS["codi_eoi"]))
+    for method in ("idw", "kriging"):
+        t0 = time.perf_counter()
+        grid = InterpolationGrid(method=method)
+        result = grid.interpolate(values)
+        t1 = time.perf_counter()
+        for _ in range(100):
+            grid.interpolate(values)
+        t2 = time.perf_counter()
+        # a l'estacio, el valor interpolat ha de ser (gairebe) el de l'estacio
+        station = InterpolationGrid(method=method, size=(2, 2), bounds=[grid.station_lon[0], grid.station_lat[0]] * 2)
+        print(f"{method}: weights {1000 * (t1 - t0):.1f} ms | per day {1000 * (t2 - t1) / 100:.3f} ms"
+              f" | range [{np.nanmin(result):.1f}, {np.nanmax(result):.1f}] within [{values.min():.1f}, {values.max():.1f}]"
+              f" | at station {station.interpolate(values)[0, 0]:.2f} = {values[0]:.2f}")
+
+    missing = values.copy()
+    missing[:5] = np.nan
+    print(f"missing stations: {np.isnan(grid.interpolate(missing)).sum()} NaN cells | 0")
+    uri, bounds = get_interpolation_image(values)
+    print(f"png: {len(uri)} chars, bounds {np.round(bounds, 3)}")
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from .icgc import LCZ_KEYS, get_VUCI_array
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Composicio LCZ d'un buffer qualsevol (punt i radi) a partir d'un raster de LCZ, en lloc dels buffers fixos
+# de 500 m de EOI_DATA[...]["LCZvsNO2_500M"].
+#
+# 1. El raster es classifica a un array uint8 amb el codi de LCZ (posicio a LCZ_KEYS, NODATA si no en te):
+#    - imatge RGB amb la paleta estandard de les LCZ (WUDAPT): es pren el color de la paleta mes proper
+#    - graella de classes tipus GeoTIFF de WUDAPT: 1..10 edificades, 11..17 = A..G, 0 sense dades
+# 2. Per a cada classe es construeix una taula d'arees sumades (summed-area table): el nombre de pixels de
+#    la classe dins de qualsevol rectangle surt de 4 lectures.
+# 3. El cercle del buffer es descompon en com a molt STRIPS franges horitzontals (rectangles), de manera que cada
+#    consulta costa O(STRIPS) lectures, independentment del radi. Tot va vectoritzat per a molts punts alhora.
+#
+# El resultat te el mateix format que idaea (percentatges per LCZ, LCZ dominant) i es pot passar a get_VUCI.
+# El raster ha d'estar en lon/lat (EPSG:4326); els radis en metres.
+# ---------------------------------------------------------------------------------------------------------------------
+NODATA = 255
+STRIPS = 32
+CHUNK = 16384
+QUERY_CHUNK = 4096
+
+# paleta estandard de les LCZ (WUDAPT), en l'ordre de LCZ_KEYS
+LCZ_PALETTE = np.array([
+    [140,   0,   0], [209,   0,   0], [255,   0,   0], [191,  77,   0], [255, 102,   0],
+    [255, 153,  85], [250, 238,   5], [188, 188, 188], [255, 204, 170], [ 85,  85,  85],
+    [  0, 106,   0], [  0, 170,   0], [100, 133,  37], [185, 219, 121], [  0,   0,   0],
+    [251, 247, 174], [106, 106, 255]], dtype=np.uint8)
+
+# distancia RGB maxima al color de la paleta (per sobre, el pixel queda sense classe: vores, text, JPEG...)
+MAX_COLOR_DISTANCE = 40.0
+
+# metres per grau de latitud (aproximacio local, suficient per a buffers de pocs km)
+METERS_PER_DEGREE = 111320.0
+
+
+def classify_rgb(rgb, max_distance = MAX_COLOR_DISTANCE, palette = LCZ_PALETTE):
+    # rgb: [files, columnes, 3 o 4] -> classes uint8 [files, columnes] (NODATA si el color no es de la paleta
+    # o si el pixel es transparent)
+    rgb = np.asarray(rgb)
+    shape = rgb.shape[:2]
+    pixels = rgb[..., :3].reshape(-1, 3).astype(np.int32)
+    palette = palette.astype(np.int32)
+    classes = np.empty(len(pixels), dtype=np.uint8)
+    for start in range(0, len(pixels), CHUNK):
+        block = pixels[start:start + CHUNK]
+        d2 = ((block[:, None, :] - palette[None, :, :])**2).sum(axis=2)
+        nearest = d2.argmin(axis=1)
+        ok = d2[np.arange(len(block)), nearest] <= max_distance**2
+        classes[start:start + CHUNK] = np.where(ok, nearest, NODATA)
+    classes = classes.reshape(shape)
+    if rgb.shape[-1] == 4:
+        classes[rgb[..., 3] == 0] = NODATA
+    return classes
+
+
+def classify_classes(grid):
+    # graella de WUDAPT (1..17, 0 o altres: sense dades) -> classes uint8 segons LCZ_KEYS
+    grid = np.asarray(grid)
+    return np.where((grid >= 1) & (grid <= len(LCZ_KEYS)), grid - 1, NODATA).astype(np.uint8)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+class LCZRaster:
+    def __init__(self, classes, transform):
+        # classes    ... array uint8 [files, columnes] (classify_rgb / classify_classes)
+        # transform  ... (lon0, dlon, lat0, dlat): lon/lat de la cantonada superior esquerra i mida del pixel
+        #                en graus (dlat negatiu si la fila 0 es la del nord, com en un GeoTIFF)
+        self.classes = np.asarray(classes, dtype=np.uint8)
+        self.lon0, self.dlon, self.lat0, self.dlat = (float(x) for x in transform)
+        nrows, ncols = self.classes.shape
+        lat_center = self.lat0 + self.dlat * nrows / 2
+        self.pixel_width = abs(self.dlon) * METERS_PER_DEGREE * np.cos(np.radians(lat_center))
+        self.pixel_height = abs(self.dlat) * METERS_PER_DEGREE
+
+        # taules d'arees sumades [classe, files + 1, columnes + 1]; l'ultima capa compta els pixels amb classe
+        nclasses = len(LCZ_KEYS)
+        dtype = np.int32 if nrows * ncols < 2**31 else np.int64
+        self.sat = np.zeros((nclasses + 1, nrows + 1, ncols + 1), dtype=dtype)
+        for k in range(nclasses):
+            np.cumsum(np.cumsum(self.classes == k, axis=0, dtype=dtype), axis=1, out=self.sat[k, 1:, 1:])
+        np.cumsum(np.cumsum(self.classes != NODATA, axis=0, dtype=dtype), axis=1, out=self.sat[nclasses, 1:, 1:])
+
+    @classmethod
+    def from_image(cls, path, transform, max_distance = MAX_COLOR_DISTANCE):
+        # imatge (PNG...) pintada amb la paleta de les LCZ; Pillow ja ve amb streamlit
+        from PIL import Image
+        with Image.open(path) as image:
+            return cls(classify_rgb(np.asarray(image.convert("RGBA")), max_distance), transform)
+
+    @classmethod
+    def from_geotiff(cls, path):
+        # GeoTIFF de classes de WUDAPT (necessita rasterio)
+        import rasterio
+        with rasterio.open(path) as src:
+            t = src.transform
+            return cls(classify_classes(src.read(1)), (t.c, t.a, t.f, t.e))
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def get_counts(self, lon, lat, radius, strips = STRIPS):
+        # pixels de cada classe dins del buffer de cada punt -> [punts, classes + 1] (l'ultima columna: total amb classe)
+        # Un pixel hi es si el seu centre cau dins del cercle. Amb fins a strips files de pixels el recompte es exacte
+        # (una franja per fila); amb mes, cada franja agrupa unes quantes files i pren l'amplada de la fila central.
+        lon, lat = np.atleast_1d(np.asarray(lon, dtype=float)), np.atleast_1d(np.asarray(lat, dtype=float))
+        nrows, ncols = self.classes.shape
+        # fila i columna (fraccionaries) de cada punt i radi en files
+        row = ((lat - self.lat0) / self.dlat)[:, None]
+        col = ((lon - self.lon0) / self.dlon)[:, None]
+        ry = radius / self.pixel_height
+        ratio = self.pixel_height / self.pixel_width
+
+        first = np.ceil(row - ry - 0.5)
+        last = np.floor(row + ry - 0.5)
+        nfiles = int(np.floor(2 * ry)) + 2
+        group = -(-nfiles // strips)
+        r0 = first + group * np.arange(-(-nfiles // group))
+        r1 = np.minimum(r0 + group, last + 1)
+        dy = (r0 + r1) / 2 - row
+        inside = dy**2 <= ry**2
+        half = np.sqrt(np.where(inside, ry**2 - dy**2, 0.0)) * ratio
+        c0 = np.ceil(col - half - 0.5)
+        c1 = np.where(inside, np.floor(col + half - 0.5) + 1, c0)
+
+        r0, r1 = np.clip(r0, 0, nrows).astype(np.intp), np.clip(r1, 0, nrows).astype(np.intp)
+        c0, c1 = np.clip(c0, 0, ncols).astype(np.intp), np.clip(c1, 0, ncols).astype(np.intp)
+        r1, c1 = np.maximum(r1, r0), np.maximum(c1, c0)
+        # suma del rectangle [r0, r1) x [c0, c1) a cada taula: S[r1, c1] - S[r0, c1] - S[r1, c0] + S[r0, c0]
+        # (en blocs de QUERY_CHUNK punts: cada lectura es [classes, punts, franges])
+        counts = np.empty((len(lon), self.sat.shape[0]), dtype=np.int64)
+        for i in range(0, len(lon), QUERY_CHUNK):
+            b = slice(i, i + QUERY_CHUNK)
+            sums = self.sat[:, r1[b], c1[b]] - self.sat[:, r0[b], c1[b]] - self.sat[:, r1[b], c0[b]] + self.sat[:, r0[b], c0[b]]
+            counts[b] = sums.sum(axis=2).T
+        return counts
+
+    def get_percent(self, lon, lat, radius, strips = STRIPS):
+        # % de cada LCZ dins del buffer (sobre els pixels amb classe), com idaea.LCZ_PERCENT; NaN si no n'hi ha cap
+        counts = self.get_counts(lon, lat, radius, strips)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.round(100.0 * counts[:, :-1] / counts[:, -1:], 2)
+
+    def get_LCZmax_code(self, lon, lat, radius, strips = STRIPS):
+        # LCZ dominant (codi enter segons LCZ_KEYS, -1 sense dades), com idaea.get_LCZmax_code -> get_VUCI_array
+        percent = self.get_percent(lon, lat, radius, strips)
+        has_data = ~np.isnan(percent).all(axis=1)
+        return np.where(has_data, np.argmax(np.nan_to_num(percent, nan=-1.0), axis=1), -1)
+
+    def get_LCZmax(self, lon, lat, radius, strips = STRIPS):
+        # com idaea.get_LCZmax, per a un punt: ({lcz: %}, LCZ dominant o "none")
+        percent = self.get_percent(lon, lat, radius, strips)[0]
+        if np.isnan(percent).all():
+            return {}, "none"
+        return dict(zip(LCZ_KEYS, percent.tolist())), LCZ_KEYS[int(np.argmax(percent))]
+
+    def get_VUCI(self, lon, lat, radius, strips = STRIPS):
+        # VUCI de la LCZ dominant de cada buffer
+        return get_VUCI_array(self.get_LCZmax_code(lon, lat, radius, strips))
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari: raster sintetic, comparat amb el recompte directe del cercle
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(0)
+    # taques de LCZ de ~20 pixels (100 m de pixel) sobre l'AMB
+    coarse = rng.integers(1, len(LCZ_KEYS) + 1, size=(40, 50))
+    grid = np.kron(coarse, np.ones((20, 20), dtype=int))
+    transform = (1.9, 0.0012, 41.6, -0.0009)
+    rgb = LCZ_PALETTE[grid - 1]
+    raster = LCZRaster(classify_rgb(rgb), transform)
+    print(f"palette round trip: {(raster.classes == classify_classes(grid)).all()} | True")
+
+    lon, lat = rng.uniform(2.0, 2.8, 20000), rng.uniform(41.0, 41.5, 20000)
+    t0 = time.perf_counter()
+    percent = raster.get_percent(lon, lat, 500)
+    t1 = time.perf_counter()
+    print(f"20000 buffers of 500 m: {1000 * (t1 - t0):.1f} ms")
+
+    # recompte directe amb la mascara del cercle per a uns quants punts
+    rows, cols = np.mgrid[0:grid.shape[0], 0:grid.shape[1]]
+    errors = []
+    for i in range(50):
+        dy = ((rows + 0.5) - (lat[i] - raster.lat0) / raster.dlat) * raster.pixel_height
+        dx = ((cols + 0.5) - (lon[i] - raster.lon0) / raster.dlon) * raster.pixel_width
+        inside = dx**2 + dy**2 <= 500**2
+        exact = 100.0 * np.bincount(raster.classes[inside], minlength=len(LCZ_KEYS))[:len(LCZ_KEYS)] / inside.sum()
+        errors.append(np.abs(exact - percent[i]).max())
+    print(f"max error vs exact circle: {max(errors):.2f} percentage points")
+    # radi gran: les franges agrupen files i el recompte passa a ser aproximat
+    big = raster.get_percent(lon[:50], lat[:50], 5000)
+    errors = []
+    for i in range(50):
+        dy = ((rows + 0.5) - (lat[i] - raster.lat0) / raster.dlat) * raster.pixel_height
+        dx = ((cols + 0.5) - (lon[i] - raster.lon0) / raster.dlon) * raster.pixel_width
+        inside = (dx**2 + dy**2 <= 5000**2) & (raster.classes != NODATA)
+        exact = 100.0 * np.bincount(raster.classes[inside], minlength=len(LCZ_KEYS))[:len(LCZ_KEYS)] / inside.sum()
+        errors.append(np.abs(exact - big[i]).max())
+    print(f"5 km buffers ({STRIPS} strips): max error {max(errors):.2f} percentage points")
+    lcz, lczmax = raster.get_LCZmax(lon[0], lat[0], 500)
+    print(f"get_LCZmax: {lczmax} ({lcz[lczmax]} %) | VUCI {raster.get_VUCI(lon[:1], lat[:1], 500)[0]}")
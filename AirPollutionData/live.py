@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import time
+import datetime
+import threading
+import collections
+
+import numpy as np
+import pandas as pd
+
+from . import ESTACIONS
+from .cache import get_ymd
+from .dades_obertes import HORES, DATA_LIMIT, where_date, where_in, get_query, read_data, get_positions
+from .fetch import SESSION
+from .icgc import get_hazard_values
+from .metrics import span
+from .risk import get_multi_risk
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Mode "en directe" del dia en curs: en lloc de tornar a descarregar el dia sencer a cada refresc, cada poll() demana
+# nomes els registres amb :updated_at posterior a l'ultim que hem vist (com StoreSync) i els aplica sobre la copia
+# en memoria hours[contaminant, estacio, hora].
+#
+#   live = LiveDay(contaminants=['NO2'])
+#   live.subscribe(lambda live, changes: ...)     # changes: taula de risc de les (estacio, contaminant) que han canviat
+#   live.poll()                                   # com a molt una consulta cada POLL_INTERVAL segons
+#   live.get_frame('NO2', codis)                  # mateix format que get_risk_data (codi_eoi, lon, lat, h01..h24)
+#
+# Nomes es recalculen el hazard i el risc de les estacions amb alguna hora nova o revisada, de manera que el transit
+# i el calcul creixen amb el que ha canviat i no amb el dia. La primera consulta (sense marca d'aigua) porta el dia
+# sencer. Si el servidor no retorna :updated_at, cada poll torna a demanar el dia sencer (el resultat es el mateix).
+# Amb ymd = None el dia segueix el calendari: passada la mitjanit es comenca de nou amb el dia nou.
+# Si la consulta falla (servidor caigut, circuit obert...), poll() torna False i es mante l'ultim estat bo, com la
+# cache (stale-while-revalidate); failures i last_error en porten el compte.
+# Els subscriptors es criden des del fil que fa poll(); els que no poden rebre callbacks (una sessio de Streamlit)
+# poden comparar version amb la que van veure i demanar get_changes(version).
+# ---------------------------------------------------------------------------------------------------------------------
+POLL_INTERVAL = 60
+MAX_CHANGES = 100
+SELECT_LIVE = [":updated_at", "codi_eoi", "contaminant", "longitud AS lon", "latitud AS lat"] + HORES
+
+
+class LiveDay:
+    def __init__(self, ymd = None, contaminants = None, stations = None, poll_interval = POLL_INTERVAL, session = SESSION):
+        self.follow_today = ymd is None
+        self.contaminants = list(contaminants or ['NO2'])
+        self.stations = list(ESTACIONS["codi_eoi"] if stations is None else stations)
+        self.poll_interval = poll_interval
+        self.session = session
+        self.subscribers = []
+        self.failures = 0
+        self.last_error = None
+        self.lock = threading.Lock()
+        self.version = 0
+        self.reset(datetime.date.today() if ymd is None else ymd)
+
+    def reset(self, ymd):
+        # estat buit d'un dia: sense registres, el NO2 pren el valor de referencia (com a l'app)
+        # version no torna a zero: qui havia vist el dia anterior veu una versio nova i, com que el registre de
+        # canvis es buida, get_changes li torna None (cal tornar a llegir l'estat sencer)
+        shape = (len(self.contaminants), len(self.stations))
+        self.ymd = get_ymd(ymd)
+        self.hours = np.full(shape + (len(HORES),), np.nan, dtype=np.float32)
+        self.has_record = np.zeros(shape, dtype=bool)
+        self.lon = np.full(len(self.stations), np.nan, dtype=np.float32)
+        self.lat = np.full(len(self.stations), np.nan, dtype=np.float32)
+        self.updated_at = None
+        self.last_poll = None
+        self.version += 1
+        self.changes = collections.deque(maxlen=MAX_CHANGES)
+        self.risk = self._compute(np.arange(len(self.stations)))
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def subscribe(self, callback):
+        # callback(live, changes); retorna la funcio per donar-se de baixa
+        self.subscribers.append(callback)
+        return lambda: self.subscribers.remove(callback) if callback in self.subscribers else None
+
+    def get_query(self):
+        where = [where_date(self.ymd), where_in("codi_eoi", self.stations), where_in("contaminant", self.contaminants)]
+        if self.updated_at:
+            where.append(f":updated_at > '{self.updated_at}'")
+        return get_query(where=where, select=SELECT_LIVE, order=":updated_at", limit=DATA_LIMIT)
+
+    def poll(self, force = False):
+        # demana els registres nous o revisats i en recalcula el risc; retorna els canvis (taula buida si no n'hi ha),
+        # None si encara no toca (POLL_INTERVAL) o un altre fil ja esta fent el poll, o False si la consulta falla
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            now = time.monotonic()
+            if not force and self.last_poll is not None and now - self.last_poll < self.poll_interval:
+                return None
+            if self.follow_today and get_ymd(datetime.date.today()) != self.ymd:
+                self.reset(datetime.date.today())
+            self.last_poll = now
+            with span("live.poll"):
+                try:
+                    df = read_data(self.get_query(), self.session)
+                except Exception as e:
+                    # es mante l'estat anterior; es tornara a provar al proper poll
+                    self.failures += 1
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    return False
+                self.last_error = None
+                changes = self.apply(df)
+        finally:
+            self.lock.release()
+        if not changes.empty:
+            for callback in list(self.subscribers):
+                callback(self, changes)
+        return changes
+
+    def apply(self, df):
+        # aplica els registres (codi_eoi, contaminant, h01..h24) sobre hours i retorna els canvis de risc
+        if df.empty:
+            return self._no_changes()
+        ipol = get_positions(self.contaminants, df["contaminant"])
+        istation = get_positions(self.stations, df["codi_eoi"])
+        keep = (ipol >= 0) & (istation >= 0)
+        ipol, istation, df = ipol[keep], istation[keep], df[keep]
+        new = df.reindex(columns=HORES).to_numpy(dtype=np.float32, na_value=np.nan)
+
+        # un registre revisat porta totes les hores: nomes compten les caselles que canvien de valor
+        old = self.hours[ipol, istation]
+        changed = ~((old == new) | (np.isnan(old) & np.isnan(new))) | ~self.has_record[ipol, istation][:, None]
+        self.hours[ipol, istation] = new
+        self.has_record[ipol, istation] = True
+        if "lon" in df.columns:
+            self.lon[istation] = df["lon"].to_numpy(dtype=np.float32)
+            self.lat[istation] = df["lat"].to_numpy(dtype=np.float32)
+        if ":updated_at" in df.columns:
+            updated_at = pd.to_datetime(df[":updated_at"]).max().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+            if self.updated_at is None or updated_at > self.updated_at:
+                self.updated_at = updated_at
+
+        rows = changed.any(axis=1)
+        if not rows.any():
+            return self._no_changes()
+        affected = np.unique(istation[rows])
+        table = self._compute(affected)
+        # la taula es [contaminant, estacio]: substituim les files de les estacions afectades
+        index = (np.arange(len(self.contaminants))[:, None] * len(self.stations) + affected[None, :]).ravel()
+        risk = self.risk.copy()
+        for column in table.columns:
+            values = risk[column].to_numpy(copy=True)
+            values[index] = table[column].to_numpy()
+            risk[column] = values
+        self.risk = risk
+
+        # canvis: nomes les parelles (contaminant, estacio) amb alguna casella nova o diferent
+        pairs = np.unique(ipol[rows] * len(self.stations) + istation[rows])
+        changes = risk.iloc[pairs].reset_index(drop=True)
+        changes["hours"] = (~np.isnan(self.hours.reshape(-1, len(HORES))[pairs])).sum(axis=1)
+        self.version += 1
+        self.changes.append((self.version, changes))
+        return changes
+
+    def _no_changes(self):
+        return self.risk.iloc[:0].assign(hours=np.zeros(0, dtype=int))
+
+    def _compute(self, istations):
+        # hazard i risc de totes les parelles (contaminant, estacio) de les estacions indicades
+        # (ordre [contaminant, estacio], com get_multi_risk)
+        ipol, ist = np.nonzero(self.has_record[:, istations])
+        df = pd.DataFrame(self.hours[ipol, istations[ist]], columns=HORES)
+        df.insert(0, "codi_eoi", np.array(self.stations, dtype=object)[istations[ist]])
+        df.insert(1, "data", pd.Timestamp(self.ymd))
+        df.insert(2, "contaminant", np.array(self.contaminants, dtype=object)[ipol])
+        return get_multi_risk(df, [self.ymd], [self.stations[i] for i in istations], self.contaminants)
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def get_changes(self, since = 0):
+        # canvis de les versions posteriors a since (None si ja no es tenen tots: cal tornar a llegir l'estat sencer)
+        if since >= self.version:
+            return self._no_changes()
+        if not self.changes or self.changes[0][0] > since + 1:
+            return None
+        return pd.concat([changes for version, changes in self.changes if version > since], ignore_index=True)
+
+    def get_frame(self, contaminant = 'NO2', codis = None):
+        # registres del contaminant, amb les columnes de get_risk_data (codi_eoi, lon, lat, h01..h24)
+        ipol = self.contaminants.index(contaminant)
+        istations = np.arange(len(self.stations)) if codis is None else get_positions(self.stations, pd.Series(codis))
+        istations = istations[(istations >= 0)]
+        istations = istations[self.has_record[ipol, istations]]
+        df = pd.DataFrame(self.hours[ipol, istations], columns=HORES)
+        df.insert(0, "codi_eoi", pd.Categorical(np.array(self.stations, dtype=object)[istations]))
+        df.insert(1, "lon", self.lon[istations])
+        df.insert(2, "lat", self.lat[istations])
+        return df
+
+    def get_hazard(self, contaminant = 'NO2'):
+        # hazard del dia de cada estacio (alineat amb stations, NaN sense registre), com get_hazard_values
+        ipol = self.contaminants.index(contaminant)
+        hazard = np.full(len(self.stations), np.nan)
+        istations = np.flatnonzero(self.has_record[ipol])
+        if len(istations):
+            hazard[istations] = get_hazard_values(pd.DataFrame(self.hours[ipol, istations], columns=HORES))
+        return hazard
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import bisect
+import functools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Temps de les etapes calentes (descarrega, parse, risc, capes del mapa, imatges) agregats en histogrames.
+#
+#   with span("socrata.fetch"):      # mesura el bloc
+#       ...
+#   @timed("map.layers")             # mesura la funcio
+#
+# Desactivat per defecte: s'activa amb AQI_METRICS=1 (o enable()). Desactivat, span() retorna sempre el mateix
+# objecte buit i timed() nomes consulta ENABLED, de manera que es pot deixar instrumentat en produccio.
+# Els histogrames s'exporten en format de text de Prometheus: get_prometheus_text(), write_prometheus(path)
+# (textfile collector) o serve_prometheus(port) (endpoint /metrics, per defecte nomes a 127.0.0.1).
+# ---------------------------------------------------------------------------------------------------------------------
+ENABLED = os.environ.get("AQI_METRICS", "0") not in ("", "0", "false")
+
+# limits superiors dels buckets, en segons (els de Prometheus, amb mes resolucio per sota de 10 ms)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_NAME = "aqi_span_seconds"
+
+
+class Histogram:
+    def __init__(self, buckets = BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)    # l'ultim es +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.last = None
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+            self.max = max(self.max, seconds)
+            self.last = seconds
+
+    def quantile(self, q):
+        # limit superior del bucket on cau el quantil q (com histogram_quantile, sense interpolar)
+        with self.lock:
+            if not self.count:
+                return None
+            target, acc = q * self.count, 0
+            for i, n in enumerate(self.counts):
+                acc += n
+                if acc >= target:
+                    return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+
+
+HISTOGRAMS = {}
+_LOCK = threading.Lock()
+
+
+def get_histogram(name):
+    histogram = HISTOGRAMS.get(name)
+    if histogram is None:
+        with _LOCK:
+            histogram = HISTOGRAMS.setdefault(name, Histogram())
+    return histogram
+
+
+def observe(name, seconds):
+    get_histogram(name).observe(seconds)
+
+
+def enable(enabled = True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def reset():
+    with _LOCK:
+        HISTOGRAMS.clear()
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+class _Span:
+    __slots__ = ("name", "t0")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.t0)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name):
+    return _Span(name) if ENABLED else _NO_SPAN
+
+
+def timed(name = None):
+    def decorator(f):
+        label = name or f.__qualname__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return f(*args, **kwargs)
+            with _Span(label):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def get_summary():
+    # una fila per span, ordenades per temps total (per a una taula o per al panell de debug de l'app)
+    rows = []
+    for name, h in sorted(HISTOGRAMS.items(), key=lambda item: -item[1].sum):
+        if not h.count:
+            continue
+        rows.append({"span": name, "count": h.count, "last_ms": round(1000 * h.last, 3),
+                     "mean_ms": round(1000 * h.sum / h.count, 3), "p50_ms": round(1000 * h.quantile(0.5), 3),
+                     "p95_ms": round(1000 * h.quantile(0.95), 3), "max_ms": round(1000 * h.max, 3),
+                     "total_ms": round(1000 * h.sum, 3)})
+    return rows
+
+
+def get_prometheus_text():
+    lines = [f"# HELP {METRIC_NAME} Duration of instrumented AirPollutionData stages.", f"# TYPE {METRIC_NAME} histogram"]
+    for name, h in sorted(HISTOGRAMS.items()):
+        with h.lock:
+            counts, total, count = list(h.counts), h.sum, h.count
+        acc = 0
+        for le, n in zip(h.buckets + ("+Inf",), counts):
+            acc += n
+            lines.append(f'{METRIC_NAME}_bucket{{span="{name}",le="{le}"}} {acc}')
+        lines.append(f'{METRIC_NAME}_sum{{span="{name}"}} {total!r}')
+        lines.append(f'{METRIC_NAME}_count{{span="{name}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    # escriptura atomica, perque el textfile collector de node_exporter no llegeixi mai un fitxer a mitges
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(get_prometheus_text())
+    os.replace(tmp, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+SERVER = None
+
+
+def serve_prometheus(port, host = "127.0.0.1"):
+    # endpoint /metrics en un fil; nomes se n'obre un per proces (l'app de Streamlit torna a executar l'script a cada canvi)
+    # per defecte nomes escolta en local: per exposar-lo a un Prometheus d'una altra maquina, host = "0.0.0.0"
+    global SERVER
+    with _LOCK:
+        if SERVER is None:
+            SERVER = ThreadingHTTPServer((host, port), _MetricsHandler)
+            SERVER.daemon_threads = True
+            threading.Thread(target=SERVER.serve_forever, daemon=True).start()
+    return SERVER
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    n = 200000
+    enable(False)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        with span("noop"):
+            pass
+    print(f"disabled span: {1e9 * (time.perf_counter() - t0) / n:.0f} ns | no histograms: {not HISTOGRAMS}")
+
+    enable(True)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        with span("empty"):
+            pass
+    print(f"enabled span: {1e9 * (time.perf_counter() - t0) / n:.0f} ns")
+
+    for ms in (1, 2, 3, 20, 200):
+        observe("stage", ms / 1000)
+    h = HISTOGRAMS["stage"]
+    print(f"count {h.count} | 5, p50 {h.quantile(0.5)} | 0.005, max {h.max} | 0.2")
+    print("\n".join(line for line in get_prometheus_text().splitlines() if 'span="stage"' in line and ("le=\"0.005\"" in line or "_count" in line)))
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import functools
+
+import numpy as np
+import pandas as pd
+
+from . import ESTACIONS
+from .icgc import SCENARIO_CODES, SCENARIO_NAMES, get_VUCI_array, get_scenario_array, get_hazard_values
+from .idaea import get_NO2_2019, get_LCZmax_code
+from .idescat import get_CVP
+from .dades_obertes import get_positions, get_days
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Motor de risc vectoritzat: hazard[estacions, dies] -> fhazard, risc i escenari en una sola passada de NumPy.
+#
+# fhazard = hazard * (VUCI + CVP) / 100
+# semafor de 3 colors: 0 sense dades | 1 fhazard < 30 | 2 fhazard < 40 | 3 fhazard >= 40
+# ---------------------------------------------------------------------------------------------------------------------
+RISK_THRESHOLDS = (30, 40)
+
+# llindars de fhazard del semafor per contaminant (els de NO2 son els del TFM). Els contaminants que no hi son
+# tenen hazard pero no risc (codi 0). Son nomes els de per defecte: get_multi_risk(thresholds=...) en pot fer servir
+# d'altres per a una crida sense afectar la resta.
+POLLUTANT_THRESHOLDS = {'NO2': RISK_THRESHOLDS}
+
+# np.nan tiene asociado el color 250_250_250.png
+COLOR3 = {0:"250_250_250.png", 1:"000_200_000.png", 2:"255_255_000.png", 3:"255_000_000.png"}
+CAPTION3 = {0:"No data", 1:"low", 2:"medium", 3:"high"}
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def _get_station_factors(codis):
+    # dades estatiques de cada estacio (no depenen del dia): es calculen una sola vegada
+    vuci = get_VUCI_array(get_LCZmax_code(codis)).astype(float)
+    cvpi = np.array([get_CVP(codi, 1) for codi in codis], dtype=float)
+    scenario = get_scenario_array(vuci, cvpi)
+    factors = {"vuci": vuci, "cvpi": cvpi, "scenario_code": SCENARIO_CODES[scenario], "scenario_name": SCENARIO_NAMES[scenario],
+               "no2_19": np.array([get_NO2_2019(codi) for codi in codis], dtype=float)}
+    # els arrays de la cache es comparteixen entre tots els que els demanen: nomes de lectura
+    for arr in factors.values():
+        arr.flags.writeable = False
+    return factors
+
+
+def get_station_factors(codis = None):
+    # vuci, cvpi, escenari i NO2 2019 de cada estacio, com a arrays alineats amb codis
+    codis = tuple(ESTACIONS["codi_eoi"] if codis is None else codis)
+    return _get_station_factors(codis)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def get_risk_code(fhazard, thresholds = RISK_THRESHOLDS):
+    fhazard = np.asarray(fhazard, dtype=float)
+    risk = np.digitize(fhazard, thresholds) + 1
+    return np.where(np.isnan(fhazard), 0, risk)
+
+
+def get_risk_batch(hazard, codis = None, missing = None, thresholds = RISK_THRESHOLDS, fallback = None):
+    # hazard   ... array [estacions] o [estacions, dies] amb la mediana horaria (NaN si no hi ha dades)
+    # codis    ... codi_eoi de cada fila de hazard (per defecte, totes les estacions del projecte)
+    # missing  ... mascara de les caselles sense registre, on fem servir el valor de referencia
+    #              (per defecte, totes les caselles NaN)
+    # fallback ... valor de referencia per estacio (p.ex. RollingAggregates.get_annual_mean);
+    #              on es NaN, o si no s'indica, el NO2 de 2019 de l'IDAEA
+    factors = get_station_factors(codis)
+    hazard = np.asarray(hazard, dtype=float)
+    extra = (slice(None),) + (None,) * (hazard.ndim - 1)
+    if missing is None:
+        missing = np.isnan(hazard)
+    reference = factors["no2_19"]
+    if fallback is not None:
+        reference = np.where(np.isnan(fallback), reference, np.asarray(fallback, dtype=float))
+    hazard = np.where(missing, reference[extra], hazard)
+
+    fhazard = hazard * (factors["vuci"] + factors["cvpi"])[extra] / 100.0
+    return {
+        "hazard": hazard,
+        "fhazard": fhazard,
+        "risk": get_risk_code(fhazard, thresholds),
+        "scenario_code": np.broadcast_to(factors["scenario_code"][extra], hazard.shape),
+        "vuci": factors["vuci"],
+        "cvpi": factors["cvpi"],
+        }
+
+
+def get_hazard_grid(df, dates, codis = None):
+    # df: registres d'un contaminant (codi_eoi, data, h01..h24) -> hazard[estacions, dies] i mascara de caselles amb registre
+    codis = pd.Index(ESTACIONS["codi_eoi"] if codis is None else codis)
+    dates = pd.DatetimeIndex(dates)
+    hazard = np.full((len(codis), len(dates)), np.nan)
+    has_record = np.zeros(hazard.shape, dtype=bool)
+    if df.empty:
+        return hazard, has_record
+    istation = get_positions(codis, df["codi_eoi"])
+    iday = dates.get_indexer(get_days(df["data"]))
+    keep = (istation >= 0) & (iday >= 0)
+    hazard[istation[keep], iday[keep]] = get_hazard_values(df[keep])
+    has_record[istation[keep], iday[keep]] = True
+    return hazard, has_record
+
+
+def get_risk_table(hazard, dates, codis = None, missing = None, fallback = None):
+    # taula llarga (codi_eoi, data, hazard, fhazard, risk, scenario_code) a partir de hazard[estacions, dies]
+    codis = list(ESTACIONS["codi_eoi"] if codis is None else codis)
+    batch = get_risk_batch(hazard, codis, missing, fallback=fallback)
+    nstations, ndays = batch["hazard"].shape
+    return pd.DataFrame({
+        "codi_eoi": np.repeat(codis, ndays),
+        "data": np.tile(pd.DatetimeIndex(dates), nstations),
+        "hazard": batch["hazard"].ravel(),
+        "fhazard": batch["fhazard"].ravel(),
+        "risk": batch["risk"].ravel(),
+        "scenario_code": batch["scenario_code"].ravel(),
+        })
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def get_multi_risk(df, dates = None, codis = None, contaminants = None, thresholds = None, fallback = None):
+    # hazard i risc de tots els contaminants i totes les estacions en una sola passada, a partir d'una descarrega
+    # (get_all_EOI_data, get_range...) amb codi_eoi, data, contaminant i h01..h24.
+    # dates        ... dies de la taula (per defecte, els de df)
+    # contaminants ... contaminants de la taula (per defecte, els de df)
+    # thresholds   ... {contaminant: llindars creixents de fhazard} (per defecte, POLLUTANT_THRESHOLDS); el semafor
+    #                  te len(llindars) + 1 colors i els contaminants que no hi son tenen risc 0
+    # Retorna la taula llarga (codi_eoi, data, contaminant, hazard, fhazard, risk, scenario_code).
+    codis = pd.Index(ESTACIONS["codi_eoi"] if codis is None else codis)
+    thresholds = POLLUTANT_THRESHOLDS if thresholds is None else thresholds
+    days = get_days(df["data"]) if not df.empty else pd.Series([], dtype="datetime64[ns]")
+    dates = pd.DatetimeIndex(sorted(days.unique()) if dates is None else dates)
+    contaminants = pd.Index(sorted(df["contaminant"].unique()) if contaminants is None else contaminants)
+
+    # graella [contaminants, estacions, dies] amb la mediana horaria de cada registre
+    hazard = np.full((len(contaminants), len(codis), len(dates)), np.nan)
+    has_record = np.zeros(hazard.shape, dtype=bool)
+    if not df.empty:
+        ipol = get_positions(contaminants, df["contaminant"])
+        istation = get_positions(codis, df["codi_eoi"])
+        iday = dates.get_indexer(days)
+        keep = (ipol >= 0) & (istation >= 0) & (iday >= 0)
+        hazard[ipol[keep], istation[keep], iday[keep]] = get_hazard_values(df[keep])
+        has_record[ipol[keep], istation[keep], iday[keep]] = True
+
+    # com a l'app, el valor de referencia (NO2 2019 o fallback) nomes substitueix el NO2 dels dies sense registre
+    factors = get_station_factors(list(codis))
+    if 'NO2' in contaminants:
+        ino2 = contaminants.get_loc('NO2')
+        reference = factors["no2_19"] if fallback is None else np.where(np.isnan(fallback), factors["no2_19"], fallback)
+        hazard[ino2] = np.where(has_record[ino2], hazard[ino2], reference[:, None])
+    fhazard = hazard * ((factors["vuci"] + factors["cvpi"]) / 100.0)[None, :, None]
+
+    # semafor amb els llindars de cada contaminant (rellenats amb inf fins al mateix nombre de llindars)
+    nmax = max([len(thresholds.get(c, ())) for c in contaminants] + [1])
+    table = np.full((len(contaminants), nmax), np.inf)
+    for i, c in enumerate(contaminants):
+        table[i, :len(thresholds.get(c, ()))] = thresholds.get(c, ())
+    risk = 1 + (fhazard[..., None] >= table[:, None, None, :]).sum(axis=-1)
+    has_scale = np.array([c in thresholds for c in contaminants])[:, None, None]
+    risk = np.where(np.isnan(fhazard) | ~has_scale, 0, risk)
+
+    npol, nstations, ndays = hazard.shape
+    return pd.DataFrame({
+        "codi_eoi": np.tile(np.repeat(np.asarray(codis), ndays), npol),
+        "data": np.tile(np.asarray(dates), npol * nstations),
+        "contaminant": np.repeat(np.asarray(contaminants), nstations * ndays),
+        "hazard": hazard.ravel(),
+        "fhazard": fhazard.ravel(),
+        "risk": risk.ravel(),
+        "scenario_code": np.tile(np.repeat(factors["scenario_code"], ndays), npol),
+        })
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    # '08101001': LCZ max 2 -> VUCI 80, CVP 17.65 -> fhazard = hazard * 0.9765
+    batch = get_risk_batch([[20.0, 35.0, 50.0, np.nan]], ['08101001'])
+    print(f"fhazard: {np.round(batch['fhazard'][0], 2)} | [19.53 34.18 48.82 32.22]")
+    print(f"risk: {batch['risk'][0]} | [1 2 3 2]")
+    print(f"scenario: {batch['scenario_code'][0]} | ['C1' 'C1' 'C1' 'C1']")
+
+    df = pd.DataFrame({"codi_eoi": ['08101001'] * 3, "data": ['2022-01-01T00:00:00.000'] * 2 + ['2022-01-02T00:00:00.000'],
+                       "contaminant": ['NO2', 'PM10', 'PM10'], "h01": [20.0, 30.0, 60.0], "h02": [22.0, 40.0, 62.0]})
+    multi = get_multi_risk(df, codis=['08101001'], thresholds={**POLLUTANT_THRESHOLDS, 'PM10': (20, 40)})
+    print(f"multi risk: {multi['risk'].tolist()} | [1 2 2 3]")
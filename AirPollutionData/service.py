@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+import io
+import re
+import json
+import time
+import asyncio
+import datetime
+import hashlib
+import argparse
+import collections
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import ESTACIONS
+from .cache import TODAY_TTL, get_ymd, is_closed_day
+from .batch import SELECT_BATCH
+from .dades_obertes import get_range, get_days
+from .metrics import span
+from .risk import get_multi_risk
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Servei HTTP (nomes lectura, asyncio) amb el risc diari de les estacions, per als taulers que ara el recalculen
+# cadascun per la seva banda.
+#
+#   python -m AirPollutionData.service --port 8080 --warm 2022-01-01 2022-12-31
+#
+#   GET /risk/{data}              ... totes les estacions i contaminants del dia (JSON, o Arrow amb ?format=arrow
+#                                     o Accept: application/vnd.apache.arrow.stream)
+#   GET /risk/{codi_eoi}/{data}   ... nomes una estacio
+#   GET /health
+#
+# La taula de cada dia (get_multi_risk) es calcula una sola vegada, en un fil, i es desa en una LRU de MAX_DAYS dies
+# amb les respostes ja serialitzades. Peticions simultanies del mateix dia esperen el mateix calcul.
+# Els dies tancats amb dades no caduquen (Cache-Control amb CLOSED_MAX_AGE); el dia d'avui, i els dies passats
+# sense cap registre (com a DataCache), es recalculen passats TODAY_TTL segons i, si el calcul falla, se serveix
+# l'ultima taula bona. Els dies futurs no existeixen (404). Cada resposta porta un ETag i un If-None-Match
+# que hi coincideix torna un 304 sense cos.
+# --warm precalcula un interval de dies amb una sola consulta abans d'obrir el port; amb --archive les dades
+# surten de l'arxiu Parquet local (read_archive) en lloc de Socrata.
+# ---------------------------------------------------------------------------------------------------------------------
+MAX_DAYS = 4000
+CLOSED_MAX_AGE = 86400
+WORKERS = 4
+ARROW_TYPE = "application/vnd.apache.arrow.stream"
+JSON_TYPE = "application/json"
+
+
+class _Day:
+    # taula d'un dia i les seves respostes serialitzades: {(codi_eoi o None, format): (cos, etag)}
+    # els JSON (el cas habitual) es generen en construir-lo, fora del bucle d'esdeveniments
+    def __init__(self, ymd, table, has_data = True):
+        self.ymd = ymd
+        self.table = table
+        # un dia passat sense registres pot ser que encara no s'hagi publicat: no es dona per tancat
+        self.closed = is_closed_day(ymd) and has_data
+        self.created = time.monotonic()
+        self.bodies = {}
+        records = get_records(table)
+        self._set_body(None, "json", json.dumps(records).encode())
+        by_station = collections.defaultdict(list)
+        for record in records:
+            by_station[record["codi_eoi"]].append(record)
+        for codi, rows in by_station.items():
+            self._set_body(codi, "json", json.dumps(rows).encode())
+        try:
+            self._set_arrow_bodies()
+        except ImportError:
+            # sense pyarrow nomes es pot servir JSON (get_body -> ImportError -> 406)
+            pass
+
+    def _set_arrow_bodies(self):
+        # una sola conversio per dia, de la taula ordenada per codi_eoi: les estacions en son talls (sense copia) i el
+        # dia sencer la torna a l'ordre original (el mateix que el JSON)
+        import pyarrow as pa
+        order = np.argsort(self.table["codi_eoi"].to_numpy(), kind="stable")
+        arrow = pa.Table.from_pandas(self.table.iloc[order], preserve_index=False)
+        self._set_body(None, "arrow", get_ipc(arrow.take(np.argsort(order))))
+        codis = self.table["codi_eoi"].to_numpy()[order]
+        starts = np.flatnonzero(np.r_[True, codis[1:] != codis[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(codis)]):
+            self._set_body(codis[start], "arrow", get_ipc(arrow.slice(start, end - start)))
+
+    def _set_body(self, codi, fmt, body):
+        self.bodies[(codi, fmt)] = (body, '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"')
+
+    def is_fresh(self, ttl):
+        return self.closed or time.monotonic() - self.created < ttl
+
+    def get_body(self, codi, fmt):
+        if (codi, fmt) not in self.bodies:
+            if fmt == "json":
+                # estacio sense files (no hauria de passar: get_multi_risk torna totes les estacions)
+                self._set_body(codi, fmt, b"[]")
+            else:
+                table = self.table if codi is None else self.table[self.table["codi_eoi"] == codi]
+                self._set_body(codi, fmt, get_arrow(table))
+        return self.bodies[(codi, fmt)]
+
+
+def get_records(table):
+    # llista de registres; data com a 'YYYY-MM-DD' i NaN com a None (null)
+    table = table.assign(data=table["data"].dt.strftime("%Y-%m-%d")).astype(object)
+    return table.where(table.notna(), None).to_dict(orient="records")
+
+
+def get_arrow(table):
+    import pyarrow as pa
+    return get_ipc(pa.Table.from_pandas(table, preserve_index=False))
+
+
+def get_ipc(arrow):
+    # taula de pyarrow -> bytes en format Arrow IPC (stream)
+    import pyarrow as pa
+    buffer = io.BytesIO()
+    with pa.ipc.new_stream(buffer, arrow.schema) as writer:
+        writer.write_table(arrow)
+    return buffer.getvalue()
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+class RiskService:
+    def __init__(self, pollutants = None, codis = None, archive = None, max_days = MAX_DAYS, ttl = TODAY_TTL, workers = WORKERS):
+        self.pollutants = list(pollutants or ['NO2'])
+        self.codis = list(ESTACIONS["codi_eoi"] if codis is None else codis)
+        self.archive = archive
+        self.max_days = max_days
+        self.ttl = ttl
+        self.days = collections.OrderedDict()
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def compute(self, start, end):
+        # taules de risc dels dies [start, end], amb les respostes JSON ja generades -> {ymd: _Day}
+        with span("service.compute"):
+            if self.archive:
+                from .archive import read_archive
+                df = read_archive(start, end, self.codis, self.pollutants, path=self.archive)
+            else:
+                df = get_range(start, end, contaminants=self.pollutants, stations=self.codis, select=SELECT_BATCH)
+            table = get_multi_risk(df, pd.date_range(get_ymd(start), get_ymd(end), freq="D"), self.codis, self.pollutants)
+        with_data = set() if df.empty else {get_ymd(day) for day in get_days(df["data"]).unique()}
+        days = {}
+        for day, part in table.groupby("data", sort=False):
+            ymd = get_ymd(day)
+            days[ymd] = _Day(ymd, part.reset_index(drop=True), ymd in with_data)
+        return days
+
+    def _store(self, days):
+        for ymd, day in days.items():
+            self.days[ymd] = day
+            self.days.move_to_end(ymd)
+        while len(self.days) > self.max_days:
+            self.days.popitem(last=False)
+
+    def warm(self, start, end):
+        self._store(self.compute(start, end))
+        return len(self.days)
+
+    async def _load(self, ymd):
+        try:
+            days = await asyncio.get_running_loop().run_in_executor(self.executor, self.compute, ymd, ymd)
+            self._store(days)
+            return self.days[ymd]
+        finally:
+            del self.pending[ymd]
+
+    async def get_day(self, ymd):
+        day = self.days.get(ymd)
+        if day is not None and day.is_fresh(self.ttl):
+            self.days.move_to_end(ymd)
+            return day
+        task = self.pending.get(ymd)
+        if task is None:
+            task = self.pending[ymd] = asyncio.ensure_future(self._load(ymd))
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            # stale-if-error: millor l'ultima taula bona que un error
+            if day is not None:
+                return day
+            raise
+
+    # -----------------------------------------------------------------------------------------------------------------
+    async def respond(self, method, target, headers):
+        # -> (estat, capcaleres, cos)
+        if method not in ("GET", "HEAD"):
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"Allow": "GET, HEAD"}, b""
+        url = urlsplit(target)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["health"]:
+            return HTTPStatus.OK, {"Content-Type": JSON_TYPE}, json.dumps({"status": "ok", "days": len(self.days)}).encode()
+        if len(parts) not in (2, 3) or parts[0] != "risk":
+            return HTTPStatus.NOT_FOUND, {}, b""
+        codi = parts[1] if len(parts) == 3 else None
+        if codi is not None and codi not in self.codis:
+            return HTTPStatus.NOT_FOUND, {}, b""
+        try:
+            if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", parts[-1]):
+                raise ValueError(parts[-1])
+            ymd = get_ymd(parts[-1])
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, {}, b""
+        if ymd > datetime.date.today().isoformat():
+            return HTTPStatus.NOT_FOUND, {}, b""
+
+        fmt = parse_qs(url.query).get("format", [None])[0]
+        if fmt is None:
+            fmt = "arrow" if ARROW_TYPE in headers.get("accept", "") else "json"
+        if fmt not in ("json", "arrow"):
+            return HTTPStatus.NOT_ACCEPTABLE, {}, b""
+
+        try:
+            day = await self.get_day(ymd)
+            body, etag = day.get_body(codi, fmt)
+        except ImportError:
+            return HTTPStatus.NOT_ACCEPTABLE, {}, b""
+        except Exception:
+            return HTTPStatus.BAD_GATEWAY, {}, b""
+        response_headers = {"Content-Type": ARROW_TYPE if fmt == "arrow" else JSON_TYPE, "ETag": etag, "Vary": "Accept",
+                            "Cache-Control": f"public, max-age={CLOSED_MAX_AGE if day.closed else self.ttl}"}
+        if etag in [t.strip() for t in headers.get("if-none-match", "").split(",")]:
+            return HTTPStatus.NOT_MODIFIED, response_headers, b""
+        return HTTPStatus.OK, response_headers, body
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 minim amb keep-alive: una peticio (sense cos) darrere l'altra a la mateixa connexio
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ")
+                except ValueError:
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+
+                status, response_headers, body = await self.respond(method, target, headers)
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" or (version == "HTTP/1.1" and connection != "close")
+                response_headers["Content-Length"] = str(len(body))
+                response_headers["Connection"] = "keep-alive" if keep_alive else "close"
+                response = [f"HTTP/1.1 {status.value} {status.phrase}"] + [f"{k}: {v}" for k, v in response_headers.items()]
+                writer.write(("\r\n".join(response) + "\r\n\r\n").encode("latin-1"))
+                if method != "HEAD" and status != HTTPStatus.NOT_MODIFIED:
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host = "127.0.0.1", port = 8080):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog="python -m AirPollutionData.service",
+                                     description="Read-only HTTP service with the daily AQI risk of the project stations")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--pollutants", nargs="+", default=['NO2'], help="pollutants (default: NO2)")
+    parser.add_argument("--archive", default=None, help="read from a local Parquet archive instead of Socrata")
+    parser.add_argument("--warm", nargs=2, metavar=("START", "END"), default=None, help="precompute these days before serving")
+    args = parser.parse_args(argv)
+
+    service = RiskService(args.pollutants, archive=args.archive)
+    if args.warm:
+        t0 = time.perf_counter()
+        n = service.warm(*args.warm)
+        print(f"{n} days precomputed in {time.perf_counter() - t0:.1f}s", flush=True)
+    print(f"serving on http://{args.host}:{args.port}/risk/{{date}}", flush=True)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
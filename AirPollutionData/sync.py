@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import argparse
+
+import pandas as pd
+
+from . import ESTACIONS
+from .cache import get_ymd
+from .dades_obertes import HORES, where_in, get_paged
+from .tensor import HourlyStore
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Sincronitzacio incremental del dataset tasf-thgu amb un magatzem local (HourlyStore).
+#
+# Es guarden dues marques d'aigua a <store>/sync.json:
+#   updated_at ... el :updated_at de Socrata mes recent que hem ingerit
+#   last_date  ... el darrer dia amb dades
+# Cada execucio nomes demana els registres amb :updated_at posterior a la marca (registres nous o revisats).
+# Si el servidor no retorna :updated_at, es tornen a demanar els dies a partir de last_date (que pot ser parcial).
+# HourlyStore.ingest sobreescriu les caselles (estacio, dia, hora), de manera que tornar a ingerir un registre
+# revisat es un upsert idempotent.
+# ---------------------------------------------------------------------------------------------------------------------
+SYNC_FILE = "sync.json"
+SELECT_SYNC = [":updated_at", "codi_eoi", "data", "contaminant"] + HORES
+
+
+class StoreSync:
+    def __init__(self, store, stations = None, pollutants = None):
+        self.store = store if isinstance(store, HourlyStore) else HourlyStore(store)
+        self.stations = list(ESTACIONS["codi_eoi"] if stations is None else stations)
+        self.pollutants = pollutants
+        self.path = os.path.join(self.store.path, SYNC_FILE)
+        self.state = {"updated_at": None, "last_date": None}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.state.update(json.load(f))
+
+    def _save_state(self):
+        # si el proces s'atura a mitges, sync.json ha de quedar com estava (si no, es tornaria a baixar tot)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+    def get_where(self, start = None):
+        where = [where_in("codi_eoi", self.stations)]
+        if self.pollutants:
+            where.append(where_in("contaminant", self.pollutants))
+        if self.state["updated_at"]:
+            where.append(f":updated_at > '{self.state['updated_at']}'")
+        elif self.state["last_date"]:
+            where.append(f"data >= '{self.state['last_date']}T00:00:00.000'")
+        elif start is not None:
+            where.append(f"data >= '{get_ymd(start)}T00:00:00.000'")
+        return where
+
+    def run(self, start = None):
+        # start nomes es fa servir la primera vegada (sense marques d'aigua): primer dia a sincronitzar
+        df = get_paged(self.get_where(start), select=SELECT_SYNC)
+        if df.empty:
+            return 0
+        n = self.store.ingest(df)
+
+        last_date = get_ymd(pd.to_datetime(df["data"]).max())
+        if self.state["last_date"] is None or last_date > self.state["last_date"]:
+            self.state["last_date"] = last_date
+        if ":updated_at" in df.columns:
+            updated_at = pd.to_datetime(df[":updated_at"]).max().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+            if self.state["updated_at"] is None or updated_at > self.state["updated_at"]:
+                self.state["updated_at"] = updated_at
+        self._save_state()
+        return n
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog="python -m AirPollutionData.sync",
+                                     description="Incremental sync of the tasf-thgu dataset into a local HourlyStore")
+    parser.add_argument("--store", required=True, help="HourlyStore directory")
+    parser.add_argument("--start", default=None, help="first day for the initial sync (YYYY-MM-DD)")
+    parser.add_argument("--pollutants", nargs="+", default=None, help="pollutants (default: all)")
+    args = parser.parse_args(argv)
+
+    sync = StoreSync(args.store, pollutants=args.pollutants)
+    if sync.state["last_date"] is None and args.start is None:
+        parser.error("--start is required for the initial sync")
+    n = sync.run(args.start)
+    print(f"{n} rows ingested | last_date {sync.state['last_date']} | updated_at {sync.state['updated_at']}")
+
+
+if __name__ == '__main__':
+    main()
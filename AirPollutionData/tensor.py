@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from . import ESTACIONS
+from .dades_obertes import HORES, get_positions, get_days
+from .cache import get_ymd
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Magatzem de valors horaris en format tensor: un fitxer float32 per contaminant, amb memoria mapejada.
+#
+#   <path>/index.json  ... {"stations": [codi_eoi, ...], "start": "YYYY-MM-DD", "days": N, "pollutants": [...]}
+#   <path>/<nom>.f32   ... float32[days, stations, 24] (NaN = hora sense dada)
+#
+# Al disc l'ordre es dia x estacio x hora perque afegir dies nomes allargui el fitxer;
+# get() retorna la vista estacio x dia x hora (sense copiar).
+# ---------------------------------------------------------------------------------------------------------------------
+INDEX_FILE = "index.json"
+NHORES = len(HORES)
+# dies que es copien de cop quan cal desplacar un fitxer (un any: ~0.7 MB amb les estacions del projecte)
+COPY_DAYS = 366
+
+
+class HourlyStore:
+    def __init__(self, path, stations = None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+        else:
+            stations = ESTACIONS["codi_eoi"] if stations is None else stations
+            self.index = {"stations": list(stations), "start": None, "days": 0, "pollutants": []}
+        self.stations = pd.Index(self.index["stations"])
+
+    # -----------------------------------------------------------------------------------------------------------------
+    @property
+    def start(self):
+        return None if self.index["start"] is None else pd.Timestamp(self.index["start"])
+
+    @property
+    def days(self):
+        return self.index["days"]
+
+    @property
+    def pollutants(self):
+        return list(self.index["pollutants"])
+
+    def get_dates(self):
+        if self.start is None:
+            return pd.DatetimeIndex([])
+        return pd.date_range(self.start, periods=self.days, freq="D")
+
+    def _file(self, contaminant):
+        return os.path.join(self.path, f"{contaminant}.f32")
+
+    def _shape(self, days = None):
+        return (self.days if days is None else days, len(self.stations), NHORES)
+
+    def _save_index(self):
+        # un index a mitges deixaria els fitxers il.legibles: l'escrivim a part i el substituim
+        file = os.path.join(self.path, INDEX_FILE)
+        tmp = f"{file}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, file)
+
+    def _memmap(self, contaminant, mode = "r"):
+        return np.memmap(self._file(contaminant), dtype=np.float32, mode=mode, shape=self._shape())
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def _resize(self, first, last):
+        # ens assegurem que l'eix de dies cobreix [first, last] per a tots els contaminants
+        if self.start is None:
+            self.index["start"], self.index["days"] = get_ymd(first), 0
+        start = min(self.start, first)
+        days = max((self.start - start).days + self.days, (last - start).days + 1)
+        shift = (self.start - start).days
+        if shift == 0 and days == self.days:
+            return
+        block = len(self.stations) * NHORES * 4
+        for contaminant in self.pollutants:
+            path = self._file(contaminant)
+            if shift == 0:
+                # nomes afegim dies al final: allarguem el fitxer i omplim el tros nou amb NaN
+                with open(path, "r+b") as f:
+                    f.truncate(days * block)
+                arr = np.memmap(path, dtype=np.float32, mode="r+", shape=self._shape(days))
+                arr[self.days:] = np.nan
+            else:
+                # dies anteriors a l'inici: cal reescriure el fitxer desplacat, per blocs de dies sencers perque
+                # la memoria no creixi amb l'historic
+                old = self._memmap(contaminant)
+                arr = np.memmap(path + ".tmp", dtype=np.float32, mode="w+", shape=self._shape(days))
+                arr[:shift] = np.nan
+                arr[shift + self.days:] = np.nan
+                for d in range(0, self.days, COPY_DAYS):
+                    arr[shift + d:shift + min(d + COPY_DAYS, self.days)] = old[d:d + COPY_DAYS]
+                arr.flush()
+                del arr, old
+                os.replace(path + ".tmp", path)
+                continue
+            arr.flush()
+            del arr
+        self.index["start"], self.index["days"] = get_ymd(start), days
+        self._save_index()
+
+    def _add_pollutant(self, contaminant):
+        arr = np.memmap(self._file(contaminant), dtype=np.float32, mode="w+", shape=self._shape())
+        arr[:] = np.nan
+        arr.flush()
+        del arr
+        self.index["pollutants"].append(contaminant)
+        self._save_index()
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def ingest(self, df, ymd = None):
+        # df: registres de dades obertes (codi_eoi, data, contaminant, h01..h24).
+        # Si no hi ha columna 'data' (consultes d'un sol dia), s'ha d'indicar ymd.
+        if df.empty:
+            return 0
+        dates = get_days(df["data"]) if "data" in df.columns else pd.Series(pd.Timestamp(get_ymd(ymd)), index=df.index)
+        istation = get_positions(self.stations, df["codi_eoi"])
+        keep = istation >= 0
+        if not keep.any():
+            return 0
+        df, dates, istation = df[keep], dates[keep], istation[keep]
+
+        self._resize(dates.min(), dates.max())
+        iday = (dates - self.start).dt.days.to_numpy()
+        values = df.reindex(columns=HORES).to_numpy(dtype=np.float32, na_value=np.nan)
+
+        for contaminant, rows in df.groupby("contaminant").indices.items():
+            if contaminant not in self.pollutants:
+                self._add_pollutant(contaminant)
+            arr = self._memmap(contaminant, "r+")
+            arr[iday[rows], istation[rows], :] = values[rows]
+            arr.flush()
+            del arr
+        return int(keep.sum())
+
+    # -----------------------------------------------------------------------------------------------------------------
+    def get(self, contaminant, start = None, end = None, stations = None):
+        # vista float32[estacions, dies, 24] de l'interval [start, end]; no es copia res del disc
+        if contaminant not in self.pollutants or self.days == 0:
+            n = len(self.stations) if stations is None else len(stations)
+            return np.full((n, 0, NHORES), np.nan, dtype=np.float32)
+        d0 = 0 if start is None else max(0, (pd.Timestamp(get_ymd(start)) - self.start).days)
+        d1 = self.days if end is None else min(self.days, (pd.Timestamp(get_ymd(end)) - self.start).days + 1)
+        arr = self._memmap(contaminant)[d0:max(d0, d1)].transpose(1, 0, 2)
+        if stations is not None:
+            arr = arr[self.stations.get_indexer(stations)]
+        return arr
+
+    def get_hazard(self, contaminant, start = None, end = None, stations = None):
+        # equivalent vectoritzat de icgc.get_hazard_data: mediana dels valors horaris existents -> [estacions, dies]
+        arr = self.get(contaminant, start, end, stations)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            return np.round(np.nanmedian(arr, axis=2), 2)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import tempfile
+
+    store = HourlyStore(tempfile.mkdtemp())
+    df = pd.DataFrame({"codi_eoi": ['08019043', '08101001'], "data": ['2022-05-02T00:00:00.000']*2,
+                       "contaminant": ['NO2']*2, "h01": [40.0, 30.0], "h02": [50.0, 32.0]})
+    store.ingest(df)
+    df["data"] = '2022-05-01T00:00:00.000'
+    store.ingest(df)
+    df["data"] = '2022-05-04T00:00:00.000'
+    store.ingest(df)
+    print(f"days: {store.days} from {store.start.date()} | 4 from 2022-05-01")
+    print(f"shape: {store.get('NO2').shape} | (21, 4, 24)")
+    print(f"hazard 08019043: {store.get_hazard('NO2', stations=['08019043'])[0]} | [45. 45. nan 45.]")
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Temps d'arrencada del paquet AirPollutionData.
+# Cada cas s'executa en un interpret nou (python -c ...) perque la cache de moduls no falsegi la mesura.
+#
+#   python benchmarks/import_time.py [--repeat 10]
+# ---------------------------------------------------------------------------------------------------------------------
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TIMER = "import time; t0 = time.perf_counter(); {code}; print(time.perf_counter() - t0)"
+
+CASES = {
+    "import AirPollutionData": "import AirPollutionData",
+    "get_scenario (numpy)": "import AirPollutionData; AirPollutionData.get_scenario(60, 55)",
+    "get_LCZmax + get_CVP": "import AirPollutionData as A; A.get_LCZmax('08101001'); A.get_CVP('08101001')",
+    "EOI_DF (pandas)": "import AirPollutionData; AirPollutionData.EOI_DF",
+    "all submodules": "import AirPollutionData; [getattr(AirPollutionData, m) for m in AirPollutionData.__all__]",
+    }
+
+
+def time_case(code, repeat):
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", TIMER.format(code=code)], cwd=ROOT, check=True,
+                             capture_output=True, text=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return {"median_ms": round(1000 * statistics.median(times), 2), "min_ms": round(1000 * min(times), 2)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="AirPollutionData import-time benchmark")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, code in CASES.items():
+        results[name] = time_case(code, args.repeat)
+        print(f"{name:28s} median {results[name]['median_ms']:8.2f} ms | min {results[name]['min_ms']:8.2f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
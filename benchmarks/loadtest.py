@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Prova de carrega local del servei de risc (AirPollutionData/service.py).
+#
+#   python benchmarks/loadtest.py                                  # aixeca el servei contra l'upstream sintetic i el mesura
+#   python benchmarks/loadtest.py --url http://127.0.0.1:8080      # o be un servei que ja esta en marxa
+#   python benchmarks/loadtest.py --revalidate --format arrow      # peticions condicionals (If-None-Match), en Arrow
+#
+# --concurrency clients (corrutines amb una connexio keep-alive cadascun) fan peticions durant --duration segons a
+# /risk/{data} o /risk/{codi_eoi}/{data} (--station-ratio), amb dies a l'atzar de l'interval --start / --end.
+# Sense --url, el servei s'executa en un altre proces (per no compartir el GIL amb els clients), amb les dades de
+# l'interval precalculades (--warm) des de l'upstream sintetic de benchmarks/replay.py.
+# ---------------------------------------------------------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+import urllib.request
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+
+import replay
+from replay import ROOT
+
+from AirPollutionData import ESTACIONS
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_service(start, end, pollutants, timeout = 120):
+    # upstream sintetic en aquest proces i el servei en un subproces que hi apunta (AQI_DATA_URL)
+    upstream, data_url = replay.start({}, replay.synthetic)
+    port = get_free_port()
+    env = dict(os.environ, AQI_DATA_URL=data_url, PYTHONPATH=ROOT)
+    process = subprocess.Popen([sys.executable, "-m", "AirPollutionData.service", "--port", str(port),
+                                "--pollutants", *pollutants, "--warm", start, end], cwd=ROOT, env=env)
+    url = f"http://127.0.0.1:{port}"
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"service exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(url + "/health", timeout=1) as response:
+                if response.status == 200:
+                    return url, process, upstream
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("service did not start")
+
+
+def get_paths(start, end, station_ratio, fmt, n, seed = 0):
+    # n camins a l'atzar (la meitat de les vegades, segons station_ratio, d'una sola estacio)
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(start, end, freq="D").strftime("%Y-%m-%d")
+    codis = ESTACIONS["codi_eoi"]
+    query = "?format=arrow" if fmt == "arrow" else ""
+    paths = []
+    for day, station, codi in zip(rng.choice(days, n), rng.random(n) < station_ratio, rng.choice(codis, n)):
+        paths.append(f"/risk/{codi}/{day}{query}" if station else f"/risk/{day}{query}")
+    return paths
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+async def client(host, port, paths, deadline, revalidate, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    etags = {}
+    i = 0
+    try:
+        while time.perf_counter() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+            if revalidate and path in etags:
+                request += f"If-None-Match: {etags[path]}\r\n"
+            t0 = time.perf_counter()
+            writer.write((request + "\r\n").encode("latin-1"))
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(":") for line in lines[1:] if line)}
+            await reader.readexactly(int(headers.get("content-length", 0)))
+            latencies.append(time.perf_counter() - t0)
+            status = int(lines[0].split(" ")[1])
+            statuses[status] = statuses.get(status, 0) + 1
+            if "etag" in headers:
+                etags[path] = headers["etag"]
+    finally:
+        writer.close()
+
+
+async def run(url, paths, concurrency, duration, revalidate):
+    host, port = urlsplit(url).hostname, urlsplit(url).port or 80
+    latencies, statuses = [], {}
+    deadline = time.perf_counter() + duration
+    # cada client recorre els camins a partir d'un punt diferent
+    step = max(1, len(paths) // concurrency)
+    t0 = time.perf_counter()
+    await asyncio.gather(*[client(host, port, paths[i * step:] + paths[:i * step], deadline, revalidate, latencies, statuses)
+                           for i in range(concurrency)])
+    return time.perf_counter() - t0, np.array(latencies), statuses
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test for the AirPollutionData risk service")
+    parser.add_argument("--url", default=None, help="running service (default: start one against the synthetic upstream)")
+    parser.add_argument("--start", default="2022-01-01", help="first day of the requested dates")
+    parser.add_argument("--end", default="2022-12-31", help="last day of the requested dates")
+    parser.add_argument("--pollutants", nargs="+", default=['NO2', 'PM10'])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--station-ratio", type=float, default=0.5, help="fraction of /risk/{codi_eoi}/{date} requests")
+    parser.add_argument("--format", choices=["json", "arrow"], default="json")
+    parser.add_argument("--revalidate", action="store_true", help="send If-None-Match with the last ETag of each path")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    process = upstream = None
+    url = args.url
+    if url is None:
+        url, process, upstream = start_service(args.start, args.end, args.pollutants)
+    try:
+        paths = get_paths(args.start, args.end, args.station_ratio, args.format, 20000)
+        elapsed, latencies, statuses = asyncio.run(run(url, paths, args.concurrency, args.duration, args.revalidate))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            upstream.shutdown()
+
+    ms = 1000 * latencies
+    results = {"requests": len(latencies), "seconds": round(elapsed, 3), "requests_per_s": round(len(latencies) / elapsed, 1),
+               "p50_ms": round(float(np.percentile(ms, 50)), 3), "p90_ms": round(float(np.percentile(ms, 90)), 3),
+               "p99_ms": round(float(np.percentile(ms, 99)), 3), "max_ms": round(float(ms.max()), 3),
+               "statuses": {str(k): v for k, v in sorted(statuses.items())}, "concurrency": args.concurrency,
+               "format": args.format, "revalidate": args.revalidate}
+    print(f"{results['requests']} requests in {results['seconds']:.1f}s | {results['requests_per_s']:,.0f} req/s"
+          f" | p50 {results['p50_ms']:.2f} ms | p90 {results['p90_ms']:.2f} ms | p99 {results['p99_ms']:.2f} ms"
+          f" | max {results['max_ms']:.2f} ms | status {results['statuses']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Memoria d'un historic de registres de tasf-thgu amb l'esquema de pd.read_json i amb dades_obertes.normalize_data.
+#
+#   python benchmarks/memory.py [--days 365]
+#
+# Els registres surten de l'upstream sintetic de benchmarks/replay.py (totes les estacions, 7 contaminants).
+# Es mesura memory_usage(deep=True): inclou els textos. Amb pandas 3 i 365 dies: 66.6 MB -> 23.9 MB (x2.8).
+# Les respostes reals tenen mes columnes de text (municipi, comarca...) i geocoded_column, i hi guanyen mes.
+# ---------------------------------------------------------------------------------------------------------------------
+import io
+import json
+import argparse
+from urllib.parse import urlencode, quote
+
+import pandas as pd
+
+import replay
+from AirPollutionData.dades_obertes import where_between, normalize_data
+
+
+def get_body(days):
+    # tots els registres (totes les estacions i contaminants) de `days` dies, en una sola resposta
+    end = pd.Timestamp("2022-01-01") + pd.Timedelta(days=days - 1)
+    query = urlencode({"$where": where_between("2022-01-01", end), "$limit": 10**7}, quote_via=quote, safe="$,'()=:")
+    return replay.synthetic(query)
+
+
+def get_memory(df):
+    return df.memory_usage(deep=True, index=False).sum()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Memory of fetched frames before and after normalize_data")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    body = get_body(args.days)
+    raw = pd.read_json(io.BytesIO(body), orient='records', dtype={"codi_eoi": str})
+    compact = normalize_data(raw)
+    results = {"days": args.days, "rows": len(raw),
+               "raw_mb": round(get_memory(raw) / 2**20, 2), "normalized_mb": round(get_memory(compact) / 2**20, 2)}
+    results["reduction"] = round(results["raw_mb"] / results["normalized_mb"], 2)
+    print(f"{results['rows']} rows ({args.days} days): read_json {results['raw_mb']} MB"
+          f" -> normalize_data {results['normalized_mb']} MB (x{results['reduction']})")
+
+    by_column = pd.DataFrame({"raw": raw.memory_usage(deep=True, index=False), "normalized": compact.memory_usage(deep=True, index=False)})
+    print((by_column / 2**10).round(1).rename(columns=lambda c: c + " KB").to_string())
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Temps de cada etapa del cami de l'app i del batch, contra respostes enregistrades de tasf-thgu (benchmarks/replay.py).
+#
+#   python benchmarks/pipeline.py --record                 # enregistra el fixture des del dataset real (cal xarxa)
+#   python benchmarks/pipeline.py --synthetic              # o be un fixture sintetic amb el mateix esquema
+#   python benchmarks/pipeline.py --json results.json      # mesura i desa els resultats
+#   python benchmarks/pipeline.py --compare results.json   # compara amb una execucio anterior (exit 1 si hi ha regressions)
+#
+# Els fixtures no es versionen (benchmarks/fixtures/ es a .gitignore). Els resultats porten el hash del fixture
+# (meta.fixture) i --compare nomes accepta una execucio feta amb el mateix fixture: per comparar dues versions del
+# codi, executeu-les amb el mateix fitxer (--fixture).
+#
+# Cada etapa s'executa un cop sense mesurar (caches de factors d'estacio, connexio keep-alive...) i despres --repeat
+# vegades. Les etapes de l'app (AirPollutionRisk, capes de pydeck) necessiten streamlit i pydeck; si no hi son, se salten.
+# ---------------------------------------------------------------------------------------------------------------------
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+import replay
+from replay import ROOT
+
+import AirPollutionData
+from AirPollutionData import dades_obertes, batch
+from AirPollutionData.dades_obertes import where_date, where_in, get_query, iter_records, RecordBuffer, SELECT_RISK
+from AirPollutionData.fetch import SESSION
+
+FIXTURE = os.path.join(ROOT, "benchmarks", "fixtures", "tasf-thgu.json.gz")
+
+DAY = "2022-03-15"
+STATION = "Barcelona (Eixample)"
+CONTAMINANT = 'NO2'
+BATCH_POLLUTANTS = ['NO2', 'PM10']
+# escales del batch: (nom, inici, final)
+BATCH_SCALES = [("1d", DAY, DAY), ("30d", "2022-03-01", "2022-03-30"), ("365d", "2022-01-01", "2022-12-31")]
+
+
+def get_app():
+    # AirPollutionRisk i get_station_map_data viuen a streamlit_app.py, que importa streamlit i pydeck
+    try:
+        import pydeck as pdk
+        import streamlit_app
+    except ImportError:
+        return None
+    return pdk, streamlit_app
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+def get_stages():
+    # llista de (nom, funcio sense arguments); les dades de cada etapa surten de l'etapa anterior, calculades una vegada
+    codis = AirPollutionData.ESTACIONS["codi_eoi"]
+    url_all = get_query(where=[where_date(DAY)])
+    url_risk = get_query(where=[where_date(DAY), where_in("codi_eoi", codis), where_in("contaminant", [CONTAMINANT])],
+                         select=SELECT_RISK)
+
+    body = SESSION.get(url_all)
+    df_all = pd.read_json(io.BytesIO(body), orient='records', dtype={"codi_eoi": str})
+    df_pol = df_all[df_all.nom_estacio.isin(AirPollutionData.ESTACIONS["nom_eoi"]) & df_all.contaminant.eq(CONTAMINANT)]
+    df_stations = {codi: df_pol[df_pol.codi_eoi.eq(codi)] for codi in codis}
+
+    def parse_stream():
+        buffer = RecordBuffer(codis, [CONTAMINANT])
+        for record in iter_records([body]):
+            buffer.append(record)
+        return buffer.to_frame()
+
+    stages = [
+        ("fetch: all stations and pollutants, 1 day", lambda: SESSION.get(url_all)),
+        ("fetch: risk query (SoQL filter), 1 day", lambda: SESSION.get(url_risk)),
+        ("parse: pd.read_json", lambda: pd.read_json(io.BytesIO(body), orient='records', dtype={"codi_eoi": str})),
+        ("parse: streaming to typed columns", parse_stream),
+        ("filter: project stations + pollutant", lambda: df_all[df_all.nom_estacio.isin(AirPollutionData.ESTACIONS["nom_eoi"])
+                                                                 & df_all.contaminant.eq(CONTAMINANT)]),
+        ("get_hazard_data x stations", lambda: [AirPollutionData.get_hazard_data(CONTAMINANT, df)
+                                                 for df in df_stations.values() if not df.empty]),
+        ("get_hazard_values (vectorized)", lambda: AirPollutionData.get_hazard_values(df_pol)),
+        ]
+
+    app = get_app()
+    if app is not None:
+        pdk, streamlit_app = app
+        df_app = dades_obertes.get_data(DAY, STATION, CONTAMINANT, use_cache=False)
+
+        def deck():
+            map_style, view, layers = streamlit_app.get_station_map_data(df_app)
+            return pdk.Deck(map_style=map_style, initial_view_state=view, layers=layers).to_json()
+
+        stages += [
+            ("AirPollutionRisk x stations", lambda: [streamlit_app.AirPollutionRisk(CONTAMINANT, codi, df)
+                                                     for codi, df in df_stations.items()]),
+            ("get_station_map_data: layers", lambda: streamlit_app.get_station_map_data(df_app)),
+            ("get_station_map_data: layers + Deck.to_json", deck),
+            ]
+
+    for name, start, end in BATCH_SCALES:
+        dates = pd.date_range(start, end, freq="D")
+        df_range = dades_obertes.get_range(start, end, contaminants=BATCH_POLLUTANTS, stations=codis, select=batch.SELECT_BATCH)
+        stages += [
+            (f"batch risk {name}: fetch + compute", lambda s=start, e=end: batch.compute_chunk(s, e, BATCH_POLLUTANTS)),
+            (f"batch risk {name}: compute", lambda df=df_range, d=dates: AirPollutionData.get_multi_risk(df, d, codis, BATCH_POLLUTANTS)),
+            ]
+    return stages
+
+
+def time_stage(stage, repeat):
+    stage()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        stage()
+        times.append(time.perf_counter() - t0)
+    return {"median_ms": round(1000 * statistics.median(times), 3), "min_ms": round(1000 * min(times), 3),
+            "p95_ms": round(1000 * float(np.percentile(times, 95)), 3), "repeat": repeat}
+
+
+def get_meta(responses):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit, "fixture": replay.get_fixture_hash(responses), "date": pd.Timestamp.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+            "numpy": np.__version__, "pandas": pd.__version__, "machine": platform.machine()}
+
+
+def compare(results, baseline, tolerance):
+    # etapes on la mediana ha empitjorat mes de tolerance (fraccio) respecte de baseline
+    regressions = []
+    for name, stats in results["stages"].items():
+        old = baseline["stages"].get(name)
+        if old is None:
+            continue
+        ratio = stats["median_ms"] / old["median_ms"] if old["median_ms"] else float("inf")
+        flag = "REGRESSION" if ratio > 1 + tolerance else ""
+        print(f"{name:46s} {old['median_ms']:10.3f} -> {stats['median_ms']:10.3f} ms  x{ratio:5.2f} {flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="AirPollutionData pipeline benchmark (replayed tasf-thgu responses)")
+    parser.add_argument("--fixture", default=FIXTURE, help="recorded responses (.json.gz)")
+    parser.add_argument("--record", action="store_true", help="record missing responses from the real dataset")
+    parser.add_argument("--synthetic", action="store_true", help="record missing responses from the synthetic upstream")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of a previous run (recorded with the same fixture)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="regression if the median gets worse by more than this fraction")
+    args = parser.parse_args()
+
+    responses = replay.load_fixture(args.fixture)
+    if args.record or args.synthetic:
+        # primer passem per totes les etapes una vegada amb el proxy, i despres mesurem nomes amb el replay
+        server, dades_obertes.URL_DATA = replay.start(responses, replay.upstream_get if args.record else replay.synthetic)
+        for name, stage in get_stages():
+            stage()
+        server.shutdown()
+        replay.save_fixture(responses, args.fixture)
+        print(f"{server.recorded} responses recorded to {args.fixture}")
+    elif not responses:
+        parser.error(f"no fixture at {args.fixture}: run with --record (or --synthetic) first")
+
+    # els fixtures no es versionen (benchmarks/fixtures/): nomes es comparen execucions amb les mateixes respostes
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        fixture = baseline.get("meta", {}).get("fixture")
+        if fixture != replay.get_fixture_hash(responses):
+            parser.error(f"{args.compare} was recorded with fixture {fixture}, not {replay.get_fixture_hash(responses)}"
+                         f" ({args.fixture}): the timings are not comparable")
+
+    server, dades_obertes.URL_DATA = replay.start(responses)
+    results = {"meta": get_meta(responses), "stages": {}}
+    for name, stage in get_stages():
+        results["stages"][name] = time_stage(stage, args.repeat)
+        stats = results["stages"][name]
+        print(f"{name:46s} median {stats['median_ms']:10.3f} ms | min {stats['min_ms']:10.3f} ms | p95 {stats['p95_ms']:10.3f} ms")
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit(1)
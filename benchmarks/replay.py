@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Servidor local que reprodueix respostes enregistrades del dataset tasf-thgu (Socrata).
+#
+# Un fixture es un fitxer .json.gz amb {consulta: cos de la resposta}, on consulta es la part de la url que va
+# darrere de '?' ($select, $where, $order, $limit, $offset). El servidor nomes serveix el que hi ha al fixture:
+# una consulta desconeguda retorna 404 (el fixture s'ha de tornar a enregistrar).
+#
+# Per enregistrar-lo, el servidor fa de proxy: les consultes que no te les demana a l'upstream i les desa.
+#   upstream = UPSTREAM_URL ... el dataset real (python benchmarks/pipeline.py --record)
+#   upstream = synthetic    ... registres sintetics amb l'esquema de tasf-thgu, per treballar sense xarxa
+# ---------------------------------------------------------------------------------------------------------------------
+import os
+import sys
+import gzip
+import hashlib
+import json
+import zlib
+import functools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import AirPollutionData
+from AirPollutionData.dades_obertes import DATA_ID, DATA_DOMAIN, HORES, CONTAMINANTS
+
+UPSTREAM_URL = "https://" + DATA_DOMAIN + "/resource/" + DATA_ID + ".json?"
+
+# contaminants que mesura cada estacio sintetica (les reals en mesuren entre 3 i 8)
+SYNTHETIC_POLLUTANTS = ['NO2', 'NO', 'NOX', 'O3', 'PM10', 'PM2.5', 'SO2']
+# estacions de fora del projecte: el dataset complet te totes les de Catalunya i get_all_EOI_data les ha de filtrar
+SYNTHETIC_EXTRA_STATIONS = 60
+
+
+def load_fixture(path):
+    if not os.path.exists(path):
+        return {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_fixture_hash(responses):
+    # hash del contingut (no del .gz, que porta la data de creacio): dues execucions nomes es poden comparar si
+    # han reproduit les mateixes respostes
+    body = json.dumps(responses, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(body).hexdigest()[:16]
+
+
+def save_fixture(responses, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(responses, f)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Upstream sintetic: interpreta el subconjunt de SoQL que genera dades_obertes.get_query
+# ---------------------------------------------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def _get_stations():
+    stations = [{"codi_eoi": codi, "nom_estacio": nom, "longitud": lon, "latitud": lat}
+                for codi, nom, lon, lat in zip(AirPollutionData.ESTACIONS["codi_eoi"], AirPollutionData.ESTACIONS["nom_eoi"],
+                                               AirPollutionData.ESTACIONS["lon"], AirPollutionData.ESTACIONS["lat"])]
+    rng = np.random.default_rng(1)
+    for i in range(SYNTHETIC_EXTRA_STATIONS):
+        stations.append({"codi_eoi": f"08{900 + i:03d}001", "nom_estacio": f"Estacio {i}",
+                         "longitud": float(rng.uniform(0.5, 3.2)), "latitud": float(rng.uniform(40.6, 42.7))})
+    return stations
+
+
+def _parse_where(where):
+    # predicats que fa servir dades_obertes: data='...', data between '...' and '...', columna in('a','b',...)
+    filters = {}
+    for predicate in where.split(" AND ") if where else []:
+        if predicate.startswith("data between "):
+            start, end = predicate[len("data between "):].split(" and ")
+            filters["data"] = (start.strip("'")[:10], end.strip("'")[:10])
+        elif predicate.startswith("data="):
+            day = predicate[len("data="):].strip("'")[:10]
+            filters["data"] = (day, day)
+        elif " in(" in predicate:
+            column, values = predicate.split(" in(", 1)
+            filters[column] = set(v.strip("'") for v in values.rstrip(")").split(","))
+        else:
+            raise ValueError(f"unsupported predicate: {predicate}")
+    return filters
+
+
+def _get_rows(filters):
+    start, end = filters.get("data", ("2022-01-01", "2022-01-01"))
+    rows = []
+    for ymd in pd.date_range(start, end, freq="D"):
+        for station in _get_stations():
+            if "codi_eoi" in filters and station["codi_eoi"] not in filters["codi_eoi"]:
+                continue
+            for contaminant in SYNTHETIC_POLLUTANTS:
+                if "contaminant" in filters and contaminant not in filters["contaminant"]:
+                    continue
+                # valors reproduibles per (estacio, contaminant, dia), amb algun forat com les dades reals
+                seed = zlib.crc32(f"{station['codi_eoi']}|{contaminant}|{ymd.toordinal()}".encode())
+                rng = np.random.default_rng(seed)
+                values = rng.gamma(4.0, 8.0, size=24).round(0)
+                row = {"codi_eoi": station["codi_eoi"], "nom_estacio": station["nom_estacio"], "tipus_estacio": "traffic",
+                       "area_urbana": "urban", "magnitud": str(CONTAMINANTS["codi"][CONTAMINANTS["nom"].index(contaminant)]),
+                       "contaminant": contaminant, "unitats": "\u00b5g/m3", "latitud": str(station["latitud"]),
+                       "longitud": str(station["longitud"]), "data": ymd.strftime("%Y-%m-%dT00:00:00.000")}
+                for hora, value in zip(HORES, values):
+                    if rng.random() > 0.03:
+                        row[hora] = f"{value:g}"
+                rows.append(row)
+    return rows
+
+
+def _select(rows, select):
+    # $select: columnes, amb alies (longitud AS lon)
+    columns = []
+    for column in select.split(","):
+        name, _, alias = column.partition(" AS ")
+        columns.append((name.strip(), (alias or name).strip()))
+    return [{alias: row[name] for name, alias in columns if name in row} for row in rows]
+
+
+def synthetic(query):
+    # resposta (bytes) que donaria Socrata a la consulta, amb registres sintetics
+    params = {k: v[0] for k, v in parse_qs(query, keep_blank_values=True).items()}
+    rows = _get_rows(_parse_where(params.get("$where")))
+    select = params.get("$select")
+    if select and select.startswith("count(*)"):
+        return json.dumps([{"n": str(len(rows))}]).encode()
+    if "$order" in params:
+        rows.sort(key=lambda row: (row["data"], row["codi_eoi"], row["contaminant"]))
+    offset = int(params.get("$offset", 0))
+    rows = rows[offset:offset + int(params.get("$limit", 1000))]
+    if select:
+        rows = _select(rows, select)
+    return json.dumps(rows).encode()
+
+
+def upstream_get(query):
+    from AirPollutionData.fetch import SESSION
+    return SESSION.get(UPSTREAM_URL + query)
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # capcaleres i cos van en escriptures separades: sense aixo, Nagle + ACK retardat afegeixen ~40 ms a les respostes petites
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        query = urlsplit(self.path).query
+        server = self.server
+        with server.lock:
+            body = server.responses.get(query)
+        status = 200
+        if body is not None:
+            body = body.encode()
+        elif server.upstream is not None:
+            try:
+                body = server.upstream(query)
+            except Exception as e:
+                # l'error de l'upstream arriba al client com a 502 i no s'enregistra
+                status, body = 502, json.dumps({"error": str(e), "query": query}).encode()
+            else:
+                with server.lock:
+                    server.responses[query] = body.decode()
+                    server.recorded += 1
+        else:
+            status, body = 404, json.dumps({"error": "query not in fixture", "query": query}).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except BrokenPipeError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def start(responses, upstream = None):
+    # servidor en un fil; retorna (server, url base per a dades_obertes.URL_DATA)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ReplayHandler)
+    server.daemon_threads = True
+    server.responses, server.upstream, server.recorded = responses, upstream, 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/resource/{DATA_ID}.json?"
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# test unitari: enregistrem una consulta sintetica i la reproduim sense upstream
+# ---------------------------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    from AirPollutionData import dades_obertes
+    from AirPollutionData.fetch import Session
+
+    session = Session(retries=0)
+    server, dades_obertes.URL_DATA = start({}, synthetic)
+    where = [dades_obertes.where_date("2022-03-01"), dades_obertes.where_in("contaminant", ['NO2'])]
+    df = dades_obertes.read_data(dades_obertes.get_query(where=where), session)
+    print(f"recorded: {len(df)} rows, {server.recorded} queries | {len(_get_stations())} rows, 1 queries")
+    server.shutdown()
+
+    server, dades_obertes.URL_DATA = start(server.responses)
+    replayed = dades_obertes.read_data(dades_obertes.get_query(where=where), session)
+    print(f"replayed equal: {replayed.equals(df)} | True")
+    try:
+        dades_obertes.read_data(dades_obertes.get_query(where=[dades_obertes.where_date("2022-03-02")]), session)
+    except Exception as e:
+        print(f"unknown query: {e} | HTTP Error 404")
+    server.shutdown()
@@ -14,6 +14,7 @@
 # limitations under the License.CO
 
 import os
+import datetime
 import numpy as np
 import pandas as pd
 
@@ -27,6 +28,14 @@ import AirPollutionData
 
 CWD = os.getcwd()
 
+# temps de les etapes (AirPollutionData.metrics): s'activen amb AQI_METRICS=1 i llavors es mostra el panell de debug.
+# AQI_METRICS_FILE ... fitxer .prom per al textfile collector de Prometheus (es reescriu a cada execucio)
+# AQI_METRICS_PORT ... port de l'endpoint /metrics
+# AQI_METRICS_HOST ... interficie de l'endpoint (per defecte 127.0.0.1; 0.0.0.0 per exposar-lo a fora)
+METRICS_FILE = os.environ.get("AQI_METRICS_FILE")
+METRICS_PORT = os.environ.get("AQI_METRICS_PORT")
+METRICS_HOST = os.environ.get("AQI_METRICS_HOST", "127.0.0.1")
+
 def get_information_about_data(eoi_name, ymd, contaminante, df):
     if df.empty:
         return f"No {contaminante} for {eoi_name} in {ymd}. We use IDAEA's 2019 mean value."
@@ -37,16 +46,31 @@ def get_information_about_data(eoi_name, ymd, contaminante, df):
 
         
         
-def get_station_map_data(df):
+# coordenadas con 5 decimales (~1 m): el JSON que se envia al navegador es mas corto
+COORD_DECIMALS = 5
+
+
+@st.cache_resource
+def get_live_day(contaminante):
+    # copia en memoria del dia en curso compartida por todas las sesiones: cada poll solo pide los registros
+    # actualizados desde el anterior (AirPollutionData.LiveDay) y recalcula solo las estaciones que han cambiado
+    return AirPollutionData.LiveDay(contaminants=[contaminante])
+
+
+@st.cache_resource
+def get_static_map_data():
+    # capas y vista que no dependen de la seleccion: se construyen una sola vez por proceso
+    # (st.cache_resource sobrevive a los reruns del script; un lru_cache se perderia en cada uno)
     # obtenemos los datos necesarios de las estaciones del proyecto que estan almacenadas en AirPollutionData.ESTACIONS y AirPollutionData.EOI_DF
-    # a partir de ellas calcularemos las capas que queremos mostrar en el mapa.
-    llocs = AirPollutionData.EOI_DF[['lon','lat','etiqueta']]
+    llocs = AirPollutionData.EOI_DF[['lon','lat','etiqueta']].round(COORD_DECIMALS)
     
     # calculamos el punto central del conjunto de estaciones.
     lonCM, latCM = AirPollutionData.get_CM(llocs)
 
     # definimos la capa d'estaciones del proyecto
+    # (ids fijos: deck.gl reconoce las capas entre reruns y no vuelve a subir sus datos a la GPU)
     layerS = pdk.Layer("ScatterplotLayer", 
+        id = "stations",
         data = llocs, 
         get_position = ['lon','lat'], 
         auto_highlight = True,
@@ -56,6 +80,7 @@ def get_station_map_data(df):
     
     # definimos ahora la capa d'etiquetas (labels) de las estaciones
     layerL = pdk.Layer("TextLayer", 
+        id = "labels",
         data = llocs, 
         get_position = ['lon','lat'], 
         get_text = 'etiqueta', 
@@ -63,69 +88,89 @@ def get_station_map_data(df):
         get_size = 12, 
         get_alignment_baseline = "'bottom'" )
 
+    # Cambiamos mapbox (default) per ICGC contextmaps: mapstyle = "mapbox://styles/mapbox/light-v9"
+    map_style = "https://geoserveis.icgc.cat/contextmaps/icgc_mapa_base_gris_simplificat.json"
+    
+    # Y ahora definimos la vista inicial:
+    init_view_state = pdk.ViewState(latitude=latCM, longitude=lonCM, zoom=10)
+
+    return ( map_style, init_view_state, [layerS, layerL] )
+
+
+@AirPollutionData.timed("map.layers")
+def get_station_map_data(df, hazard = None):
+    # hazard: valores diarios de todas las estaciones (alineados con ESTACIONS["codi_eoi"], NaN si no hay datos).
+    # Si se indica, se anade debajo de las estaciones la interpolacion (IDW) sobre el area de las estaciones.
+    # Las capas de las estaciones y la vista inicial vienen de get_static_map_data; aqui solo se construyen
+    # las que cambian con la seleccion (interpolacion del dia y estacion escogida).
+    map_style, init_view_state, static_layers = get_static_map_data()
+
+    # capa de la interpolacion: los pesos de la malla se calculan una sola vez, cada dia es un producto matriz-vector
+    layersI = []
+    if hazard is not None:
+        image, bounds = AirPollutionData.get_interpolation_image(hazard)
+        layersI = [pdk.Layer("BitmapLayer", id = "interpolation", image = image, bounds = bounds, opacity = 0.8)]
+
     # ahora nos falta la capa de la estacion escogida, si es que hay datos asociados
     if df.empty:
-        selected_layers = [layerS, layerL]
+        selected_layers = layersI + static_layers
     else:
         layerP = pdk.Layer("ScatterplotLayer", 
-            data =  df[['lon','lat','codi_eoi']], 
+            id = "selection",
+            data = [{'lon': round(float(lon), COORD_DECIMALS), 'lat': round(float(lat), COORD_DECIMALS), 'codi_eoi': codi}
+                    for lon, lat, codi in zip(df['lon'].tolist(), df['lat'].tolist(), df['codi_eoi'].tolist())], 
             get_position = ['lon','lat'], 
             auto_highlight = True,
             get_radius = 500, 
             get_color = '[255,0,255,150]', 
             pickable = True )
 
-        selected_layers = [layerS, layerL, layerP]
+        selected_layers = layersI + static_layers + [layerP]
 
-    # Una vez tenemos las capas que queremos poner en el mapa (selected_layers), vamos a definir el mapa base. 
-    # Cambiamos mapbox (default) per ICGC contextmaps: mapstyle = "mapbox://styles/mapbox/light-v9"
-    map_style = "https://geoserveis.icgc.cat/contextmaps/icgc_mapa_base_gris_simplificat.json"
-    
-    # Y ahora definimos la vista inicial:
-    init_view_state = pdk.ViewState(latitude=latCM, longitude=lonCM, zoom=10)
-    
     return ( map_style, init_view_state, selected_layers )
 
 
+# etapas de la pagina medidas con AirPollutionData.timed (sin coste si AQI_METRICS no esta activo)
+@AirPollutionData.timed("app.get_data")
+def get_data(ymd, eoi_name, contaminante):
+    return AirPollutionData.get_data(ymd, eoi_name, contaminante)
+
+
+@AirPollutionData.timed("map.render")
+def show_map(container, mapstyle, initviewstate, selectedlayers):
+    # pydeck_chart serializa el Deck a JSON
+    container.pydeck_chart( pdk.Deck(map_style = mapstyle, initial_view_state = initviewstate, layers = selectedlayers) )
+
+
+@AirPollutionData.timed("image.load")
+def show_image(container, image, **kwargs):
+    container.image(image, **kwargs)
+
+
 
 class AirPollutionRisk:
+    @AirPollutionData.timed("app.risk")
     def __init__(self, contaminante, eoi_code, df):
         # calculamos los porcentajes de cada LCZ, que se almacenan en un diccionario {lcz:%}
         # devolvemos tambien el codigo de LCZ maximo
         self.lcz_dict, self.lcz_max = AirPollutionData.get_LCZmax(eoi_code)
         
-        # obtenemos el Vulnerability Urban Climate Index (VUCI): 
-        self.vuci = AirPollutionData.get_VUCI(self.lcz_max)
-    
-        # calculamos el Climate Vulnerable People Index (CVPI):
-        self.cvpi = AirPollutionData.get_CVP(eoi_code, 1) # percentatge de població vulnerable (infants i vells)
-
-        # ahora determinamos el VUCI-CVPI escenario
-        self.scenario_code, self.scenario_name = AirPollutionData.get_scenario(self.vuci, self.cvpi)
-
-        self.no2_19 = AirPollutionData.get_NO2_2019(eoi_code)
+        # el resto (VUCI, CVPI, escenario, hazard y semaforo) lo calcula el motor vectorizado
+        # de AirPollutionData.risk, aqui con una sola estacion y un solo dia.
         if df.empty:
-            self.hazard_value = self.no2_19
+            hazard = np.nan
         else:
-            self.hazard_value = AirPollutionData.get_hazard_data(contaminante, df)
-            
-        # self.risk = self.hazard_value x self.scenario_code
-        # vamos a modificar el self.hazard_value segun los valores de self.vuci i self.cvpi.
-        if np.isnan(self.hazard_value):
-            kcolor3 = 0
-        else:
-            fhazard = self.hazard_value * (self.vuci + self.cvpi)/100.0
-            if fhazard < 30:
-                kcolor3 = 1
-            elif fhazard < 40:
-                kcolor3 = 2
-            else:
-                kcolor3 = 3
-            
-        # np.nan tiene asociado el color 250_250_250.png
-        COLOR3 = {0:"250_250_250.png", 1:"000_200_000.png", 2:"255_255_000.png", 3:"255_000_000.png"}
-        CAPTION3 = {0:"No data", 1:"low", 2:"medium", 3:"high"}
-        
+            hazard = AirPollutionData.get_hazard_data(contaminante, df)
+        batch = AirPollutionData.get_risk_batch([hazard], [eoi_code], missing=[df.empty])
+        factors = AirPollutionData.get_station_factors([eoi_code])
+
+        self.vuci = factors["vuci"][0]
+        self.cvpi = factors["cvpi"][0] # percentatge de població vulnerable (infants i vells)
+        self.scenario_code, self.scenario_name = factors["scenario_code"][0], factors["scenario_name"][0]
+        self.no2_19 = factors["no2_19"][0]
+        self.hazard_value = batch["hazard"][0]
+        self.fhazard = batch["fhazard"][0]
+
         #COLOR7 = { 0:"250_250_250.png", 1:"000_255_000.png", 2:"000_200_000.png", 3:"255_255_000.png", 4:"255_150_000.png", 5:"255_055_000.png", 6:"255_000_000.png", 7:"150_010_050.png" }
         #CAPTION7 = {0:"No data", 1:"low", 2:"low", 3:"medium", 4:"medium", 5:"medium", 6:"high", 7:"high"}
         #COLOR7TO3 = { 0:0, 1:1, 2:1, 3:2, 4:2, 5:2, 6:3, 7:3 }
@@ -161,10 +206,10 @@ class AirPollutionRisk:
         # Asi pues nos "machacamos" las variables que habiamos asignado de 7 colores 
         #self.risk = COLOR7TO3[kcolor7]
         
-        self.risk = kcolor3
+        self.risk = int(batch["risk"][0])
         
-        self.risk_image = COLOR3[self.risk]
-        self.risk_caption = CAPTION3[self.risk]
+        self.risk_image = AirPollutionData.COLOR3[self.risk]
+        self.risk_caption = AirPollutionData.CAPTION3[self.risk]
 
         
 
@@ -204,26 +249,46 @@ if __name__ == '__main__':
     #contaminante = row1_1.radio("pollutant:", ('NO2', 'PM2.5'))
     #contaminante = row1_1.selectbox("contaminant:", pd.DataFrame(AirPollutionData.CONTAMINANTS)) 
     contaminante = 'NO2'
+    # mapa interpolado entre estaciones (una consulta mas: los datos del dia de todas las estaciones)
+    interpolated = row1_1.checkbox(f"interpolated {contaminante} map")
     
+    # buscamos el codigo de estacion asociado a eoi_name:
+    eoi_code = AirPollutionData.get_codi_eoi(eoi_name)
+
+    # El dia en curso tiene solo las horas h01..hNN que ya se han publicado: en modo "live" no se vuelve a
+    # descargar el dia entero en cada refresco, sino solo las filas que han cambiado desde la ultima consulta.
+    live = None
+    if ymd == datetime.date.today() and row1_1.toggle("live hourly updates", value=True):
+        live = get_live_day(contaminante)
+        live.poll()
+
     # A partir de estos datos, obtenemos los datos (JSON) del dataset de dades obertes.
     # En principio nos tiene que devolver un DataFrame con solo una fila. En caso contrario el DataFrame estara vacio.
-    df = AirPollutionData.get_data(ymd, eoi_name, contaminante)
+    if live is not None:
+        df = live.get_frame(contaminante, [eoi_code])
+    else:
+        df = get_data(ymd, eoi_name, contaminante)
 
     # Primero, vamos a pintar el mapa de situacion de las estaciones:
-    mapstyle, initviewstate, selectedlayers = get_station_map_data(df)
+    hazard = None
+    if interpolated and live is not None:
+        hazard = live.get_hazard(contaminante)
+    elif interpolated:
+        df_all = AirPollutionData.get_contaminant_data(ymd, contaminante)
+        if not df_all.empty:
+            hazard = pd.Series(AirPollutionData.get_hazard_values(df_all), index=df_all.codi_eoi)
+            hazard = hazard.groupby(level=0).mean().reindex(AirPollutionData.ESTACIONS["codi_eoi"]).to_numpy()
+    mapstyle, initviewstate, selectedlayers = get_station_map_data(df, hazard)
     # row1_2.map(data=df, zoom=13, use_container_width=True)
-    row1_2.pydeck_chart( pdk.Deck(map_style = mapstyle, initial_view_state = initviewstate, layers = selectedlayers) )
+    show_map(row1_2, mapstyle, initviewstate, selectedlayers)
 
-    # buscamos el codigo de estacion asociado a eoi_name:
-    eoi_code = AirPollutionData.get_codi_eoi(eoi_name)
-    
     # calculamos todos los datos del riesgo associado al contaminante:
     risk_data = AirPollutionRisk(contaminante, eoi_code, df)
 
     row1_1.write(" ")
     row1_1.subheader(f" {contaminante} Air Quality Index:")
     # aqui pondremos el semaforo con el risk_data.risk
-    row1_1.image(risk_data.risk_image, caption=risk_data.risk_caption, width=150)
+    show_image(row1_1, risk_data.risk_image, caption=risk_data.risk_caption, width=150)
 
     # ======================================================
     # Vamos a comprovar si tenemos datos o no y calculamos todos los datos del riesgo asociado al contaminante:
@@ -235,7 +300,7 @@ if __name__ == '__main__':
     row2_1, row2_2 = st.columns((2,3))
     # imagen del buffer de LCZ de la estacion escogida (eoi_code)
     row2_1.write(f"LCZ data in {eoi_name} area")
-    row2_1.image(f"{eoi_code}_lcz.jpg")
+    show_image(row2_1, f"{eoi_code}_lcz.jpg")
     
     # pintamos ahora el histograma de valores del contaminante...
     if not df.empty:
@@ -315,3 +380,33 @@ if __name__ == '__main__':
     col10.image("LCZ10.png") # col10.image(AirPollutionData.get_LCZ_image('10'))
     col10.metric(AirPollutionData.LCZ_NAME['10'], "")
 
+    # ======================================================
+    # modo live: cada POLL_INTERVAL segundos un fragmento consulta las novedades y, si ha cambiado la estacion
+    # escogida, vuelve a ejecutar la pagina. La version vista se guarda en el estado de la sesion.
+    if live is not None:
+        st.session_state["live_version"] = live.version
+
+        @st.fragment(run_every=AirPollutionData.live.POLL_INTERVAL)
+        def live_updates():
+            live.poll()
+            seen = st.session_state.get("live_version", live.version)
+            if live.version > seen:
+                changes = live.get_changes(seen)
+                st.session_state["live_version"] = live.version
+                if changes is None or eoi_code in changes["codi_eoi"].values:
+                    st.rerun()
+            st.caption(f"Live data for {live.ymd}: last update {live.updated_at or '-'}"
+                       + (f" | upstream unavailable, showing the last data received ({live.last_error})" if live.last_error else ""))
+
+        live_updates()
+
+    # ======================================================
+    # panel de debug con los tiempos de cada etapa (solo si AQI_METRICS=1)
+    if AirPollutionData.metrics.ENABLED:
+        with st.expander("Debug: stage timings"):
+            st.dataframe(pd.DataFrame(AirPollutionData.metrics.get_summary()))
+            st.download_button("Prometheus metrics", AirPollutionData.metrics.get_prometheus_text(), file_name="aqi_metrics.prom")
+        if METRICS_FILE:
+            AirPollutionData.metrics.write_prometheus(METRICS_FILE)
+        if METRICS_PORT:
+            AirPollutionData.metrics.serve_prometheus(int(METRICS_PORT), METRICS_HOST)